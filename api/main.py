@@ -1,25 +1,174 @@
-from typing import Annotated
+import hashlib
+import json
+import zlib
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, AsyncIterator, Dict, Optional
 
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from helpers.DBHelper import DBHelper, MatchQueryFilter, SummonerHistoryFilter
-from helpers.RiotHelper import RiotHelper
+from helpers.DBHelper import (
+    EXPORT_BATCH_SIZE,
+    INGEST_VERSION,
+    LaneDiffFilter,
+    MatchExportFilter,
+    MatchQueryFilter,
+    SummonerHistoryFilter,
+    SummonerStatsFilter,
+    get_next_page_cursor,
+    get_page_key,
+)
+from helpers.FrameStore import lane_diffs
+from helpers.Resources import Resources
+from helpers.SingleFlight import SingleFlight
 
-dbh = DBHelper()
-rh = RiotHelper()
-app = FastAPI()
+try:
+    import zstandard
+except ImportError:
+    # zstd compressed exports are only available with the zstandard package
+    zstandard = None
 
+resources = Resources()
+match_fetches = SingleFlight()
 
-@app.get("/match/{item_id}")
-async def get_match_by_id(match_id: str):
-    db_response = await dbh.get_matches_v5(MatchQueryFilter(match_id=match_id))
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # clients are created and warmed on startup instead of on import
+    await resources.open()
+    yield
+    await resources.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# pass the value as `cursor` to get the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def page_response(response: Response, documents, page_filter, fast: bool):
+    next_cursor = get_next_page_cursor(documents, page_filter)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return fast_response(documents, response) if fast else documents
+
+
+def fast_response(documents, response: Optional[Response] = None) -> ORJSONResponse:
+    """
+    Encodes the documents with orjson, skipping jsonable_encoder and the default json
+    encoder. Only for plain mongo documents, which are json compatible as they are.
+    Clients opt in with the `Fast-Json: true` header.
+    """
+    headers = dict(response.headers) if response else None
+    return ORJSONResponse(documents, headers=headers)
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag of everything a response depends on"""
+    raw = json.dumps([INGEST_VERSION, *parts], separators=(",", ":"))
+    return f'"{hashlib.sha1(raw.encode()).hexdigest()}"'
+
+
+def page_etag(page_filter, versions: Dict[str, int], fast: bool) -> str:
+    """
+    ETag of a page at the given ingest versions. The versions change with every match
+    that could be on the page, so a current ETag is answered without the page query.
+    """
+    return make_etag(
+        type(page_filter).__name__,
+        get_page_key(page_filter),
+        sorted(versions.items()),
+        fast,
+    )
+
+
+async def page_not_modified(page_filter, if_none_match: Optional[str], fast: bool):
+    """304 response if the client has the current page, checked before the query"""
+    if not if_none_match:
+        return None
+    versions = await resources.db_helper.get_page_versions(page_filter)
+    if versions is None:
+        return None
+    etag = page_etag(page_filter, versions, fast)
+    return not_modified(etag) if etag_matches(if_none_match, etag) else None
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    if not if_none_match or not etag:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def get_compressor(compression: str):
+    """Streaming compressor with compress and flush methods, None for no compression"""
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+async def export_lines(export_filter: MatchExportFilter) -> AsyncIterator[bytes]:
+    compressor = get_compressor(export_filter.compression)
+    lines = []
+    async for document in resources.db_helper.stream_matches(export_filter):
+        lines.append(orjson.dumps(document) + b"\n")
+        # one chunk per cursor batch keeps the memory use constant
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            chunk = b"".join(lines)
+            lines = []
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = b"".join(lines)
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+
+async def fetch_and_store_match(match_id: str) -> Optional[Dict[str, Any]]:
+    document = await resources.riot_helper.get_match_raw_riot(match_id)
+    if not document:
+        return None
+    # written through, so the next request for the match is served from the database
+    stored_ids = await resources.db_helper.insert_matches([document])
+    # the timeline is fetched later by the timeline backfill
+    await resources.db_helper.add_timeline_backlog(list(stored_ids))
+    return document
+
+
+@app.get("/match/{match_id}")
+async def get_match_by_id(
+    match_id: str,
+    response: Response,
+    fast_json: Annotated[bool, Header()] = False,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    # stored matches never change, a client that has the ETag has the match
+    etag = make_etag("match", match_id, fast_json)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    db_response = await resources.db_helper.get_matches_v5(
+        MatchQueryFilter(match_id=match_id)
+    )
     db_match = db_response[0] if len(db_response) > 0 else None
     if db_match:
-        return db_match
+        response.headers["ETag"] = etag
+        return fast_response(db_match, response) if fast_json else db_match
     else:
-        riot_match = await rh.get_match_riot(match_id)
+        # concurrent misses for the same match share a single Riot-API request
+        riot_match = await match_fetches.do(
+            match_id, lambda: fetch_and_store_match(match_id)
+        )
         if riot_match:
-            return riot_match
+            response.headers["ETag"] = etag
+            return fast_response(riot_match, response) if fast_json else riot_match
         else:
             raise HTTPException(
                 status_code=404, detail=f"Match with id [${match_id}] not found"
@@ -27,11 +176,21 @@ async def get_match_by_id(match_id: str):
 
 
 @app.get("/matches")
-async def get_matches(match_filter: Annotated[MatchQueryFilter, Query()]):
-    db_response = await dbh.get_matches_v5(match_filter)
+async def get_matches(
+    match_filter: Annotated[MatchQueryFilter, Query()],
+    response: Response,
+    fast_json: Annotated[bool, Header()] = False,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    cached = await page_not_modified(match_filter, if_none_match, fast_json)
+    if cached:
+        return cached
+    db_response, versions = await resources.db_helper.get_matches_page(match_filter)
     db_matches = db_response if len(db_response) > 0 else None
     if db_matches:
-        return db_matches
+        if versions is not None:
+            response.headers["ETag"] = page_etag(match_filter, versions, fast_json)
+        return page_response(response, db_matches, match_filter, fast_json)
     else:
         raise HTTPException(
             status_code=404, detail="No matches found that match the filter"
@@ -39,12 +198,91 @@ async def get_matches(match_filter: Annotated[MatchQueryFilter, Query()]):
 
 
 @app.get("/history")
-async def get_matches(history_filter: Annotated[SummonerHistoryFilter, Query()]):
-    db_response = await dbh.get_summoner_match_history(history_filter)
+async def get_matches(
+    history_filter: Annotated[SummonerHistoryFilter, Query()],
+    response: Response,
+    fast_json: Annotated[bool, Header()] = False,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
+    cached = await page_not_modified(history_filter, if_none_match, fast_json)
+    if cached:
+        return cached
+    db_response, versions = await resources.db_helper.get_summoner_match_history(
+        history_filter
+    )
     db_matches = db_response if len(db_response) > 0 else None
     if db_matches:
-        return db_matches
+        if versions is not None:
+            response.headers["ETag"] = page_etag(history_filter, versions, fast_json)
+        return page_response(response, db_matches, history_filter, fast_json)
     else:
         raise HTTPException(
             status_code=404, detail="No summoner history found that match the filter"
         )
+
+
+@app.get("/export")
+async def export_matches(export_filter: Annotated[MatchExportFilter, Query()]):
+    """
+    Streams every match of the filter as NDJSON in ascending matchId order. An
+    interrupted export is resumed by passing the last received matchId as `after`.
+    """
+    if export_filter.compression == "zstd" and zstandard is None:
+        raise HTTPException(status_code=400, detail="zstd compression is not available")
+    headers = {}
+    if export_filter.compression:
+        headers["Content-Encoding"] = export_filter.compression
+    return StreamingResponse(
+        export_lines(export_filter),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@app.get("/stats")
+async def get_stats(
+    stats_filter: Annotated[SummonerStatsFilter, Query()],
+    fast_json: Annotated[bool, Header()] = False,
+):
+    """Totals per queue, champion and patch, maintained while matches are ingested"""
+    db_stats = await resources.db_helper.get_summoner_stats(stats_filter)
+    if db_stats:
+        return fast_response(db_stats) if fast_json else db_stats
+    else:
+        raise HTTPException(
+            status_code=404, detail="No summoner stats found that match the filter"
+        )
+
+
+@app.get("/mastery")
+async def get_mastery(puuid: str, fast_json: Annotated[bool, Header()] = False):
+    db_mastery = await resources.db_helper.get_mastery(puuid)
+    if db_mastery:
+        return fast_response(db_mastery) if fast_json else db_mastery
+    else:
+        raise HTTPException(
+            status_code=404, detail=f"No mastery found for Summoner [{puuid}]"
+        )
+
+
+@app.get("/lane-diff")
+async def get_lane_diff(lane_filter: Annotated[LaneDiffFilter, Query()]):
+    """Average gold, xp and cs difference to the lane opponent at the given minutes"""
+    matchups = await resources.db_helper.get_lane_matchups(lane_filter)
+    timelines = {
+        timeline["matchId"]: timeline
+        for timeline in await resources.db_helper.get_timelines(
+            [matchup["matchId"] for matchup in matchups]
+        )
+    }
+    matchups = [matchup for matchup in matchups if matchup["matchId"] in timelines]
+    if not matchups:
+        raise HTTPException(
+            status_code=404, detail="No games with a timeline found for the summoner"
+        )
+    return lane_diffs(
+        [timelines[matchup["matchId"]] for matchup in matchups],
+        [matchup["participantId"] for matchup in matchups],
+        [matchup["opponentId"] for matchup in matchups],
+        lane_filter.minutes,
+    )
@@ -0,0 +1,80 @@
+import math
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from helpers.DBHelper import DBHelper
+from helpers.Scheduler import Job
+
+
+class ActivityPolicy:
+    """
+    Interval policy for the match sync jobs. Summoners who haven't played for a while
+    are polled exponentially less often, but the backoff is relaxed around the hours
+    of the day they usually play, learned from their stored matches.
+    """
+
+    def __init__(
+        self,
+        idle_after: float = 2 * 60 * 60,
+        max_backoff_exponent: int = 5,
+        active_hour_share: float = 0.08,
+        active_hour_speedup: int = 4,
+        history: int = 100,
+    ):
+        self.db_helper = DBHelper()
+        self.idle_after = idle_after
+        self.max_backoff_exponent = max_backoff_exponent
+        self.active_hour_share = active_hour_share
+        self.active_hour_speedup = active_hour_speedup
+        self.history = history
+
+    def backoff_factor(self, last_played: float, now: float) -> int:
+        idle = now - last_played
+        if idle < self.idle_after:
+            return 1
+        exponent = int(math.log2(idle / self.idle_after)) + 1
+        return 2 ** min(exponent, self.max_backoff_exponent)
+
+    def is_active_hour(self, creations: List[int], now: float) -> bool:
+        if not creations:
+            return False
+        hours = [0] * 24
+        for creation in creations:
+            hours[datetime.fromtimestamp(creation / 1000, timezone.utc).hour] += 1
+        # games started in the current or the next hour count as usual play time
+        hour = datetime.fromtimestamp(now, timezone.utc).hour
+        share = (hours[hour] + hours[(hour + 1) % 24]) / len(creations)
+        return share >= self.active_hour_share
+
+    async def __call__(self, jobs: List[Job]) -> Dict[str, float]:
+        puuids = [job.target for job in jobs]
+        summoners = {
+            summoner["puuid"]: summoner
+            for summoner in await self.db_helper.get_summoners(puuids=puuids, limit=0)
+        }
+        recent_creations = await self.db_helper.get_recent_game_creations(
+            puuids, self.history
+        )
+
+        now = time.time()
+        intervals: Dict[str, float] = {}
+        for job in jobs:
+            summoner = summoners.get(job.target, {})
+            creations = recent_creations.get(job.target, [])
+            # revisionDate changes when a game ends, even if we haven't stored it yet
+            last_played = max(
+                [
+                    summoner.get("matchSync", {}).get("newest") or 0,
+                    summoner.get("revisionDate") or 0,
+                    *creations,
+                ]
+            )
+            if not last_played:
+                continue
+
+            factor = self.backoff_factor(last_played / 1000, now)
+            if self.is_active_hour(creations, now):
+                factor = max(1, factor // self.active_hour_speedup)
+            intervals[job.jobId] = job.interval * factor
+        return intervals
@@ -0,0 +1,112 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache. Entries can expire after `ttl` seconds and
+    carry tags, so every entry depending on e.g. a summoner can be dropped at once.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.expires: Dict[Hashable, float] = {}
+        self.entry_tags: Dict[Hashable, Set[str]] = {}
+        self.tagged_keys: Dict[str, Set[Hashable]] = {}
+        # invalidations are counted, so a load can tell if its tags were invalidated
+        # while it ran. Only the tags of running loads keep their last invalidation.
+        self.generation = 0
+        self.cleared_generation = 0
+        self.loading_tags: Dict[str, int] = {}
+        self.tag_generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self.entries:
+            if self.ttl is None or self.expires[key] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.pop(key)
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()):
+        self.pop(key)
+        self.entries[key] = value
+        if self.ttl is not None:
+            self.expires[key] = time.monotonic() + self.ttl
+        self.entry_tags[key] = set(tags)
+        for tag in self.entry_tags[key]:
+            self.tagged_keys.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key: Hashable):
+        if key not in self.entries:
+            return
+        del self.entries[key]
+        self.expires.pop(key, None)
+        for tag in self.entry_tags.pop(key, set()):
+            keys = self.tagged_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged_keys[tag]
+
+    def invalidate_tags(self, tags: Iterable[str]):
+        self.generation += 1
+        for tag in set(tags):
+            if tag in self.loading_tags:
+                self.tag_generations[tag] = self.generation
+            for key in list(self.tagged_keys.get(tag, ())):
+                self.pop(key)
+
+    def clear(self):
+        self.generation += 1
+        self.cleared_generation = self.generation
+        self.entries.clear()
+        self.expires.clear()
+        self.entry_tags.clear()
+        self.tagged_keys.clear()
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        tags: Iterable[str] = (),
+    ) -> Any:
+        """
+        Load and cache missing values, empty results (e.g. errors) are not cached.
+        A value is not cached either if its tags were invalidated during the load, as
+        it may have been read before the change.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        tags = set(tags)
+        start = self.generation
+        for tag in tags:
+            self.loading_tags[tag] = self.loading_tags.get(tag, 0) + 1
+        try:
+            value = await loader()
+            stale = self.cleared_generation > start or any(
+                self.tag_generations.get(tag, 0) > start for tag in tags
+            )
+        finally:
+            for tag in tags:
+                self.loading_tags[tag] -= 1
+                if not self.loading_tags[tag]:
+                    del self.loading_tags[tag]
+                    self.tag_generations.pop(tag, None)
+        if value and not stale:
+            self.set(key, value, tags)
+        return value
@@ -1,16 +1,91 @@
 import asyncio
+import base64
+import json
 import os
+import re
+import sys
+import time
 from threading import Lock
-from typing import List, Dict, Any, Union
+from typing import (
+    Annotated,
+    AsyncIterator,
+    List,
+    Dict,
+    Any,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from pymongo import UpdateOne
+from pydantic import BaseModel, Field, field_validator
+from pymongo import DeleteMany, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
 
+from helpers.Cache import LRUCache
+from helpers.FrameStore import FRAME_FIELDS, pack_frames
+from helpers.IndexManager import IndexManager, IndexSpec, derive_filter_indexes
+from interfaces.ChampionMasteryDTO import ChampionMasteryDTO
 from interfaces.MatchV5DTO import MatchV5DTO
 from interfaces.SummonerDTO import SummonerDTO
 
 
+DUPLICATE_KEY_ERROR = 11000
+FIELD_PATTERN = re.compile(r"[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*")
+# cached match documents and /matches or /history pages
+MATCH_CACHE_SIZE = 2000
+QUERY_CACHE_SIZE = 1000
+QUERY_CACHE_TTL = 60
+# tag of cached pages that aren't restricted to some summoners
+ALL_MATCHES_TAG = "*"
+# documents fetched per round trip of an export, bounds its memory use
+EXPORT_BATCH_SIZE = 500
+# part of the ETags of match documents and pages, bump it when the stored layout changes
+INGEST_VERSION = 1
+# connection pool of the mongo client, can be overridden in the environment
+MONGODB_MAX_POOL_SIZE = 100
+MONGODB_MIN_POOL_SIZE = 10
+MONGODB_MAX_IDLE_TIME_MS = 5 * 60 * 1000
+# rebuilt collections are written here first and replace the original with $out
+REBUILD_SUFFIX = "_rebuild"
+# ingest version of every page, bumped when participant_stats is rebuilt
+REBUILD_VERSION_KEY = "rebuild"
+# failed timeline fetches are retried with an exponential backoff, after the last
+# attempt the match is only kept in the backlog as a record
+TIMELINE_RETRY_DELAY = 60 * 60 * 1000
+TIMELINE_MAX_ATTEMPTS = 5
+
+
+def encode_page_cursor(game_creation: int, match_id: str) -> str:
+    """Opaque continuation token pointing behind the given match"""
+    raw = json.dumps([game_creation, match_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_page_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        game_creation, match_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return int(game_creation), str(match_id)
+    except Exception:
+        raise ValueError("Invalid page cursor")
+
+
+def validate_page_cursor(cursor: str) -> str:
+    if cursor:
+        decode_page_cursor(cursor)
+    return cursor
+
+
+def validate_fields(fields: str) -> str:
+    for field in fields.split(","):
+        if field and not FIELD_PATTERN.fullmatch(field.strip()):
+            raise ValueError(f"Invalid field [{field}]")
+    return fields
+
+
 class MatchQueryFilter(BaseModel):
     # unique
     match_id: str = ""
@@ -20,8 +95,21 @@ class MatchQueryFilter(BaseModel):
     mode: str = ""
     match_type: str = ""
     game_version: str = ""
+    # the cursor of the previous page takes precedence over the offset
+    cursor: str = ""
     offset: int = 0
     limit: int = 5
+    # comma separated field paths or the name of a preset, e.g. "summary"
+    fields: str = ""
+
+    _validate_cursor = field_validator("cursor")(validate_page_cursor)
+    _validate_fields = field_validator("fields")(validate_fields)
+
+
+class MatchExportFilter(MatchQueryFilter):
+    # the pages are ignored, an export is resumed after the last exported matchId
+    after: str = ""
+    compression: Literal["", "gzip", "zstd"] = ""
 
 
 class SummonerHistoryFilter(BaseModel):
@@ -32,8 +120,30 @@ class SummonerHistoryFilter(BaseModel):
     mode: str = ""
     match_type: str = ""
     game_version: str = ""
+    # the cursor of the previous page takes precedence over the offset
+    cursor: str = ""
     offset: int = 0
     limit: int = 20
+    # comma separated field paths or the name of a preset, e.g. "summary"
+    fields: str = ""
+
+    _validate_cursor = field_validator("cursor")(validate_page_cursor)
+    _validate_fields = field_validator("fields")(validate_fields)
+
+
+class SummonerStatsFilter(BaseModel):
+    puuid: str
+    queue: int = -1
+    champion: int = -1
+    patch: str = ""
+
+
+class LaneDiffFilter(BaseModel):
+    puuid: str
+    queue: int = -1
+    # the summoner's last games with a lane opponent
+    limit: int = Field(default=20, ge=1, le=100)
+    minutes: List[Annotated[int, Field(ge=0)]] = [10, 15]
 
 
 def parse_filter_to_dict(
@@ -41,15 +151,27 @@ def parse_filter_to_dict(
 ) -> Dict[str, Any]:
     filter_dict: Dict[str, Any] = {}
 
-    # Common fields for both filter types
+    # Common fields for both filter types, the history is served from participant_stats
+    # which stores the match info fields at the top level
+    prefix = "info." if isinstance(filter_obj, MatchQueryFilter) else ""
     if hasattr(filter_obj, "queue") and filter_obj.queue != -1:
-        filter_dict["info.queueId"] = filter_obj.queue
+        filter_dict[f"{prefix}queueId"] = filter_obj.queue
     if hasattr(filter_obj, "mode") and filter_obj.mode:
-        filter_dict["info.gameMode"] = filter_obj.mode
+        filter_dict[f"{prefix}gameMode"] = filter_obj.mode
     if hasattr(filter_obj, "match_type") and filter_obj.match_type:
-        filter_dict["info.gameType"] = filter_obj.match_type
+        filter_dict[f"{prefix}gameType"] = filter_obj.match_type
     if hasattr(filter_obj, "game_version") and filter_obj.game_version:
-        filter_dict["info.gameVersion"] = filter_obj.game_version
+        filter_dict[f"{prefix}gameVersion"] = filter_obj.game_version
+
+    # Keyset pagination, pages are sorted by (gameCreation, matchId) descending
+    if hasattr(filter_obj, "cursor") and filter_obj.cursor:
+        game_creation, match_id = decode_page_cursor(filter_obj.cursor)
+        creation_field = f"{prefix}gameCreation"
+        match_id_field = "metadata.matchId" if prefix else "matchId"
+        filter_dict["$or"] = [
+            {creation_field: {"$lt": game_creation}},
+            {creation_field: game_creation, match_id_field: {"$lt": match_id}},
+        ]
 
     # Specific fields for MatchQueryFilter
     if isinstance(filter_obj, MatchQueryFilter):
@@ -63,11 +185,382 @@ def parse_filter_to_dict(
     # Specific fields for SummonerHistoryFilter
     elif isinstance(filter_obj, SummonerHistoryFilter):
         if filter_obj.puuid:
-            filter_dict["metadata.participants"] = {"$all": [filter_obj.puuid]}
+            filter_dict["puuid"] = filter_obj.puuid
 
     return filter_dict
 
 
+def get_next_page_cursor(
+    documents: List[Dict[str, Any]],
+    filter_obj: Union[MatchQueryFilter, SummonerHistoryFilter],
+) -> Optional[str]:
+    """Cursor of the page following the documents, None if this was the last page"""
+    if not documents or len(documents) < filter_obj.limit:
+        return None
+    last = documents[-1]
+    if isinstance(filter_obj, MatchQueryFilter):
+        return encode_page_cursor(
+            last["info"]["gameCreation"], last["metadata"]["matchId"]
+        )
+    return encode_page_cursor(last["gameCreation"], last["matchId"])
+
+
+def get_page_key(filter_obj: Union[MatchQueryFilter, SummonerHistoryFilter]) -> str:
+    """Canonical json of a page filter, the same page always has the same key"""
+    if isinstance(filter_obj, MatchQueryFilter):
+        filter_obj = filter_obj.model_copy(
+            update={"participant_puuids": sorted(filter_obj.participant_puuids)}
+        )
+    return filter_obj.model_dump_json()
+
+
+def get_page_tags(
+    filter_obj: Union[MatchQueryFilter, SummonerHistoryFilter]
+) -> List[str]:
+    """Cache tags and ingest version keys of a page, the summoners it is limited to"""
+    if isinstance(filter_obj, MatchQueryFilter):
+        return sorted(filter_obj.participant_puuids) or [ALL_MATCHES_TAG]
+    return [filter_obj.puuid or ALL_MATCHES_TAG]
+
+
+def build_index_registry() -> List[IndexSpec]:
+    """Every index of the database, indexes missing here are dropped by init_indexes"""
+    page_fields = ["cursor", "offset", "limit", "fields"]
+    return [
+        IndexSpec(collection="summoner", keys=[("puuid", 1)], unique=True),
+        IndexSpec(collection="job", keys=[("jobId", 1)], unique=True),
+        IndexSpec(collection="job", keys=[("nextRun", 1)]),
+        IndexSpec(collection="match_v5", keys=[("metadata.matchId", 1)], unique=True),
+        IndexSpec(collection="timeline_v5", keys=[("matchId", 1)], unique=True),
+        IndexSpec(collection="timeline_backlog", keys=[("matchId", 1)], unique=True),
+        # due retries, matches without retries left have no retryAt
+        IndexSpec(collection="timeline_backlog", keys=[("retryAt", 1)]),
+        IndexSpec(
+            collection="mastery", keys=[("puuid", 1), ("championId", 1)], unique=True
+        ),
+        IndexSpec(
+            collection="mastery_history",
+            keys=[("puuid", 1), ("championId", 1), ("snapshotTime", -1)],
+        ),
+        IndexSpec(
+            collection="summoner_stats",
+            keys=[("puuid", 1), ("queueId", 1), ("championId", 1), ("patch", 1)],
+            unique=True,
+        ),
+        # /matches, a match id matches at most one document and needs no page index
+        *derive_filter_indexes(
+            MatchQueryFilter,
+            parse_filter_to_dict,
+            "match_v5",
+            [("info.gameCreation", -1), ("metadata.matchId", -1)],
+            ignored_fields=["match_id", *page_fields],
+        ),
+        *derive_filter_indexes(
+            MatchQueryFilter,
+            parse_filter_to_dict,
+            "match_v5",
+            [("info.gameCreation", -1), ("metadata.matchId", -1)],
+            anchor="participant_puuids",
+            ignored_fields=["match_id", *page_fields],
+        ),
+        IndexSpec(
+            collection="participant_stats",
+            keys=[("puuid", 1), ("matchId", 1)],
+            unique=True,
+        ),
+        # all participants of some matches, e.g. the lane opponents
+        IndexSpec(collection="participant_stats", keys=[("matchId", 1)]),
+        # /history, always queried for one summoner
+        *derive_filter_indexes(
+            SummonerHistoryFilter,
+            parse_filter_to_dict,
+            "participant_stats",
+            [("gameCreation", -1), ("matchId", -1)],
+            anchor="puuid",
+            ignored_fields=page_fields,
+        ),
+    ]
+
+
+def serialize_match(match: Union[MatchV5DTO, Dict[str, Any]]) -> Dict[str, Any]:
+    """Convert a match to the document stored in match_v5, keeping riot's field names"""
+    if isinstance(match, BaseModel):
+        return match.model_dump(mode="json", by_alias=True, exclude_none=True)
+    return match
+
+
+# match info and participant fields copied to the participant_stats documents
+PARTICIPANT_STATS_INFO_FIELDS = [
+    "gameCreation",
+    "gameDuration",
+    "gameMode",
+    "gameType",
+    "gameVersion",
+    "mapId",
+    "queueId",
+]
+PARTICIPANT_STATS_FIELDS = [
+    "puuid",
+    "riotIdGameName",
+    "riotIdTagline",
+    "participantId",
+    "teamId",
+    "teamPosition",
+    "championId",
+    "championName",
+    "champLevel",
+    "kills",
+    "deaths",
+    "assists",
+    "win",
+    "totalMinionsKilled",
+    "neutralMinionsKilled",
+    "goldEarned",
+    "totalDamageDealtToChampions",
+    "visionScore",
+    "item0",
+    "item1",
+    "item2",
+    "item3",
+    "item4",
+    "item5",
+    "item6",
+    "summoner1Id",
+    "summoner2Id",
+]
+
+
+# named projections for the fields parameter, pages always keep the cursor fields
+MATCH_FIELD_PRESETS = {
+    "summary": [
+        "metadata.matchId",
+        "metadata.participants",
+        "info.gameCreation",
+        "info.gameDuration",
+        "info.gameMode",
+        "info.gameVersion",
+        "info.queueId",
+        "info.participants.puuid",
+        "info.participants.riotIdGameName",
+        "info.participants.riotIdTagline",
+        "info.participants.teamId",
+        "info.participants.championId",
+        "info.participants.championName",
+        "info.participants.kills",
+        "info.participants.deaths",
+        "info.participants.assists",
+        "info.participants.win",
+    ],
+    "scoreboard": [
+        "metadata.matchId",
+        "metadata.participants",
+        "info.gameCreation",
+        "info.gameDuration",
+        "info.gameMode",
+        "info.gameVersion",
+        "info.queueId",
+        "info.teams.teamId",
+        "info.teams.win",
+        "info.teams.objectives",
+        *[
+            f"info.participants.{field}"
+            for field in PARTICIPANT_STATS_FIELDS
+            if field != "participantId"
+        ],
+    ],
+}
+HISTORY_FIELD_PRESETS = {
+    "summary": [
+        "matchId",
+        "gameCreation",
+        "gameDuration",
+        "queueId",
+        "championId",
+        "championName",
+        "kills",
+        "deaths",
+        "assists",
+        "win",
+    ],
+    # participant_stats documents are a scoreboard row already
+    "scoreboard": [],
+}
+
+
+def parse_fields_to_projection(
+    filter_obj: Union[MatchQueryFilter, SummonerHistoryFilter]
+) -> Dict[str, int]:
+    if isinstance(filter_obj, MatchQueryFilter):
+        presets = MATCH_FIELD_PRESETS
+        cursor_fields = ["info.gameCreation", "metadata.matchId"]
+    else:
+        presets = HISTORY_FIELD_PRESETS
+        cursor_fields = ["gameCreation", "matchId"]
+
+    fields_value = filter_obj.fields.strip()
+    if fields_value in presets:
+        fields = presets[fields_value]
+    else:
+        fields = [field.strip() for field in fields_value.split(",") if field.strip()]
+    if not fields:
+        return {"_id": 0}
+
+    # mongo rejects a path together with one of its sub paths
+    fields = sorted(set(fields + cursor_fields))
+    projection = {
+        field: 1
+        for field in fields
+        if not any(field.startswith(f"{other}.") for other in fields)
+    }
+    projection["_id"] = 0
+    return projection
+
+
+def build_participant_stats(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One compact document per participant of a serialized match"""
+    info = match.get("info", {})
+    match_fields = {"matchId": match["metadata"]["matchId"]}
+    for field in PARTICIPANT_STATS_INFO_FIELDS:
+        if field in info:
+            match_fields[field] = info[field]
+
+    stats = []
+    for participant in info.get("participants", []):
+        if not participant.get("puuid"):
+            continue
+        participant_fields = {
+            field: participant[field]
+            for field in PARTICIPANT_STATS_FIELDS
+            if field in participant
+        }
+        stats.append({**match_fields, **participant_fields})
+    return stats
+
+
+# a mastery snapshot only stores the champions where one of these changed
+MASTERY_DELTA_FIELDS = ["championPoints", "championLevel", "lastPlayTime"]
+
+# participant_stats fields summed up in the summoner_stats documents
+SUMMONER_STATS_COUNTERS = [
+    "kills",
+    "deaths",
+    "assists",
+    "totalMinionsKilled",
+    "neutralMinionsKilled",
+    "goldEarned",
+    "totalDamageDealtToChampions",
+    "visionScore",
+    "gameDuration",
+]
+
+
+def get_patch(game_version: str) -> str:
+    """The patch of a gameVersion, e.g. 14.20 of 14.20.628.3907"""
+    return ".".join(game_version.split(".")[:2])
+
+
+def build_summoner_stats_update(stats: Dict[str, Any]) -> UpdateOne:
+    """Adds a participant_stats document to the totals of its summoner_stats document"""
+    increments = {field: stats.get(field) or 0 for field in SUMMONER_STATS_COUNTERS}
+    increments["games"] = 1
+    increments["wins"] = 1 if stats.get("win") else 0
+    return UpdateOne(
+        {
+            "puuid": stats["puuid"],
+            "queueId": stats.get("queueId"),
+            "championId": stats.get("championId"),
+            "patch": get_patch(stats.get("gameVersion") or ""),
+        },
+        {
+            "$inc": increments,
+            "$set": {"championName": stats.get("championName")},
+            "$max": {"lastPlayed": stats.get("gameCreation") or 0},
+        },
+        upsert=True,
+    )
+
+
+# columns of the event table, damage breakdowns of champion kills are dropped
+TIMELINE_EVENT_FIELDS = [
+    "timestamp",
+    "type",
+    "participantId",
+    "killerId",
+    "victimId",
+    "assistingParticipantIds",
+    "creatorId",
+    "teamId",
+    "killerTeamId",
+    "itemId",
+    "afterId",
+    "beforeId",
+    "goldGain",
+    "bounty",
+    "shutdownBounty",
+    "killStreakLength",
+    "multiKillLength",
+    "killType",
+    "skillSlot",
+    "level",
+    "levelUpType",
+    "wardType",
+    "monsterType",
+    "monsterSubType",
+    "buildingType",
+    "towerType",
+    "laneType",
+]
+
+
+def build_timeline(timeline: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compact document of a raw timeline: the participant frames packed into one numeric
+    array (see FrameStore) and a flat table of all events
+    """
+    info = timeline.get("info", {})
+    frames = info.get("frames", [])
+    puuids = {
+        participant["participantId"]: participant.get("puuid")
+        for participant in info.get("participants", [])
+    }
+
+    participant_ids = sorted(puuids)
+    participant_frames = [
+        [
+            frame.get("participantFrames", {}).get(str(participant_id), {})
+            for frame in frames
+        ]
+        for participant_id in participant_ids
+    ]
+
+    events = []
+    for frame in frames:
+        for event in frame.get("events", []):
+            row = {
+                field: event[field]
+                for field in TIMELINE_EVENT_FIELDS
+                if event.get(field) is not None
+            }
+            if "position" in event:
+                row["x"] = event["position"].get("x")
+                row["y"] = event["position"].get("y")
+            events.append(row)
+
+    return {
+        "matchId": timeline["metadata"]["matchId"],
+        "gameId": info.get("gameId"),
+        "frameInterval": info.get("frameInterval"),
+        "timestamps": [frame.get("timestamp") for frame in frames],
+        "participants": [
+            {"participantId": participant_id, "puuid": puuids[participant_id]}
+            for participant_id in participant_ids
+        ],
+        "frameFields": FRAME_FIELDS,
+        "frames": pack_frames(participant_frames),
+        "events": events,
+    }
+
+
 class DBHelper:
     _instance: Any = None
     _lock: Lock = Lock()
@@ -82,17 +575,12 @@ class DBHelper:
                     # Initialize MongoDB Connection
                     mongodb_connection_string = os.getenv("MONGODB_CONNECTION_STRING")
                     if mongodb_connection_string:
-                        cls._instance.mongo_client = AsyncIOMotorClient(
-                            mongodb_connection_string
-                        )
-                        cls._instance.database = (
-                            cls._instance.mongo_client.get_database("cnap")
-                        )
-                        cls._instance.match_collection = (
-                            cls._instance.database.get_collection("match_v5")
-                        )
-                        cls._instance.summoner_collection = (
-                            cls._instance.database.get_collection("summoner")
+                        cls._instance.connect()
+
+                        # Initialize Caches, pages expire as other processes ingest
+                        cls._instance.match_cache = LRUCache(MATCH_CACHE_SIZE)
+                        cls._instance.query_cache = LRUCache(
+                            QUERY_CACHE_SIZE, QUERY_CACHE_TTL
                         )
                     else:
                         raise ValueError(
@@ -100,25 +588,68 @@ class DBHelper:
                         )
         return cls._instance
 
+    def connect(self):
+        """
+        Create the client, again after a disconnect, e.g. when the api starts again or
+        another task runs in the same process
+        """
+        self.mongo_client = AsyncIOMotorClient(
+            os.getenv("MONGODB_CONNECTION_STRING"),
+            maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", MONGODB_MAX_POOL_SIZE)),
+            minPoolSize=int(os.getenv("MONGODB_MIN_POOL_SIZE", MONGODB_MIN_POOL_SIZE)),
+            maxIdleTimeMS=int(
+                os.getenv("MONGODB_MAX_IDLE_TIME_MS", MONGODB_MAX_IDLE_TIME_MS)
+            ),
+        )
+        self.database = self.mongo_client.get_database("cnap")
+        self.match_collection = self.database.get_collection("match_v5")
+        self.summoner_collection = self.database.get_collection("summoner")
+        self.participant_stats_collection = self.database.get_collection(
+            "participant_stats"
+        )
+        self.job_collection = self.database.get_collection("job")
+        self.summoner_stats_collection = self.database.get_collection("summoner_stats")
+        self.mastery_collection = self.database.get_collection("mastery")
+        self.mastery_history_collection = self.database.get_collection(
+            "mastery_history"
+        )
+        self.export_state_collection = self.database.get_collection("export_state")
+        self.timeline_collection = self.database.get_collection("timeline_v5")
+        self.timeline_backlog_collection = self.database.get_collection(
+            "timeline_backlog"
+        )
+        self.ingest_version_collection = self.database.get_collection("ingest_version")
+        self.connected = True
+
     async def disconnect(self):
         self.mongo_client.close()
+        self.connected = False
         print("Disconnected from MongoDB")
 
-    async def init_indexes(self):
-        try:
-            await self.summoner_collection.create_index("puuid", unique=True)
-            print("Created index on summoner.puuid")
-
-            await self.match_collection.create_index("metadata.matchId", unique=True)
-            print("Created index on match_v5.metadata.matchId")
-
-            await self.match_collection.create_index("metadata.participants")
-            print("Created index on match_v5.info.participants")
+    async def warmup(self):
+        """Connect before the first query, the pool then fills up to minPoolSize"""
+        await self.database.command("ping")
+        print("Connected to MongoDB")
 
+    async def init_indexes(self, drop_obsolete: bool = True):
+        try:
+            index_manager = IndexManager(self.database, build_index_registry())
+            await index_manager.reconcile(drop_obsolete)
             print("All indexes created successfully")
         except Exception as error:
             print(f"Error creating indexes: {error}")
 
+    async def print_index_usage(self):
+        try:
+            index_manager = IndexManager(self.database, build_index_registry())
+            for collection, usage in (await index_manager.get_usage()).items():
+                for stats in usage:
+                    print(
+                        f"{collection}.{stats['name']}: {stats['ops']} ops since {stats['since']}"
+                    )
+        except Exception as error:
+            print(f"Error getting index usage: {error}")
+
     async def get_non_existing_match_ids(self, ids: List[str]):
         try:
             if not ids:
@@ -143,33 +674,362 @@ class DBHelper:
             print("Could not check for existing match ids: ", error)
             return []
 
-    async def update_matches(self, matches: List[MatchV5DTO]):
+    async def update_matches(self, matches: List[Union[MatchV5DTO, Dict[str, Any]]]):
         try:
+            documents = [serialize_match(match) for match in matches]
             bulk_ops = [
                 UpdateOne(
-                    {"metadata.matchId": match["metadata"]["matchId"]},
-                    {"$set": match},
+                    {"metadata.matchId": document["metadata"]["matchId"]},
+                    {"$set": document},
                     upsert=True,
                 )
-                for match in matches
+                for document in documents
             ]
-            result = await self.match_collection.bulk_write(bulk_ops)
+            result = await self.match_collection.bulk_write(bulk_ops, ordered=False)
             print(
-                f"Upserted {result.upserted_count} and modified {result.modified_count} summoner data Inserted {result.inserted_count} Match data"
+                f"Upserted {result.upserted_count} and modified {result.modified_count} Match data"
             )
-            return True
+            self.invalidate_cached_matches(documents, changed=True)
+            await self.bump_ingest_versions(documents)
+            # only new matches are counted, updated ones are in the totals already
+            await self.update_summoner_stats(
+                [documents[index] for index in result.upserted_ids]
+            )
+            return await self.update_participant_stats(documents)
         except Exception as error:
             print("Error uploading matches to MongoDB: ", error)
             return False
 
+    async def insert_matches(self, documents: List[Dict[str, Any]]) -> Set[str]:
+        """
+        Insert new serialized matches in one unordered batch. Returns the ids of the
+        matches that are stored afterwards, including ones that already existed.
+        """
+        match_ids = [document["metadata"]["matchId"] for document in documents]
+        if not documents:
+            return set()
+        try:
+            # insert_many adds an _id to the documents, the callers keep theirs clean
+            result = await self.match_collection.insert_many(
+                [dict(document) for document in documents], ordered=False
+            )
+            print(f"Inserted {len(result.inserted_ids)} Match data")
+            stored_ids = set(match_ids)
+            existing_ids = set()
+        except BulkWriteError as error:
+            failed_ids = set()
+            existing_ids = set()
+            for write_error in error.details.get("writeErrors", []):
+                # a duplicate key means the match was stored in the meantime
+                if write_error.get("code") == DUPLICATE_KEY_ERROR:
+                    existing_ids.add(match_ids[write_error["index"]])
+                else:
+                    failed_ids.add(match_ids[write_error["index"]])
+                    print(
+                        f"Error inserting Match [{match_ids[write_error['index']]}]: {write_error.get('errmsg')}"
+                    )
+            print(
+                f"Inserted {error.details.get('nInserted', 0)} of {len(documents)} Match data"
+            )
+            stored_ids = set(match_ids) - failed_ids
+        except Exception as error:
+            print("Error inserting matches to MongoDB: ", error)
+            return set()
+
+        stored_documents = [
+            document
+            for document in documents
+            if document["metadata"]["matchId"] in stored_ids
+        ]
+        # a failure is only logged, the matches are stored and the stats can be
+        # recreated with rebuild_participant_stats and rebuild_summoner_stats
+        await self.update_participant_stats(stored_documents)
+        await self.update_summoner_stats(
+            [
+                document
+                for document in stored_documents
+                if document["metadata"]["matchId"] not in existing_ids
+            ]
+        )
+        self.invalidate_cached_matches(stored_documents)
+        await self.bump_ingest_versions(stored_documents)
+        return stored_ids
+
+    async def insert_timelines(self, timelines: List[Dict[str, Any]]) -> bool:
+        """Store raw timelines in their compact layout, existing ones are kept"""
+        try:
+            documents = [build_timeline(timeline) for timeline in timelines]
+            if not documents:
+                return True
+            result = await self.timeline_collection.insert_many(
+                documents, ordered=False
+            )
+            print(f"Inserted {len(result.inserted_ids)} Timeline data")
+            return True
+        except BulkWriteError as error:
+            write_errors = error.details.get("writeErrors", [])
+            failed = [
+                write_error
+                for write_error in write_errors
+                if write_error.get("code") != DUPLICATE_KEY_ERROR
+            ]
+            for write_error in failed:
+                print(f"Error inserting Timeline: {write_error.get('errmsg')}")
+            print(
+                f"Inserted {error.details.get('nInserted', 0)} of {len(timelines)} Timeline data"
+            )
+            return not failed
+        except Exception as error:
+            print("Error inserting timelines to MongoDB: ", error)
+            return False
+
+    async def bump_ingest_versions(self, matches: List[Dict[str, Any]]):
+        """
+        Count the change of the pages that could contain the matches, the same keys as
+        the cache tags. Other processes compare the versions instead of the pages, e.g.
+        for the ETags of /matches and /history.
+        """
+        if not matches:
+            return
+        keys = {ALL_MATCHES_TAG}
+        for match in matches:
+            keys.update(match["metadata"].get("participants", []))
+        try:
+            await self.ingest_version_collection.bulk_write(
+                [
+                    UpdateOne({"_id": key}, {"$inc": {"version": 1}}, upsert=True)
+                    for key in keys
+                ],
+                ordered=False,
+            )
+        except Exception as error:
+            print("Error updating ingest versions in MongoDB: ", error)
+
+    async def get_ingest_versions(self, keys: List[str]) -> Optional[Dict[str, int]]:
+        """Versions of the keys, 0 for keys that never changed, None on errors"""
+        try:
+            versions = {key: 0 for key in keys}
+            async for document in self.ingest_version_collection.find(
+                {"_id": {"$in": list(keys)}}
+            ):
+                versions[document["_id"]] = document["version"]
+            return versions
+        except Exception as error:
+            print("Error getting ingest versions with MongoDB: ", error)
+            return None
+
+    async def get_page_versions(
+        self, page_filter: Union[MatchQueryFilter, SummonerHistoryFilter]
+    ) -> Optional[Dict[str, int]]:
+        """Current ingest versions of a page, one indexed read instead of the query"""
+        return await self.get_ingest_versions(
+            [*get_page_tags(page_filter), REBUILD_VERSION_KEY]
+        )
+
+    async def _get_versioned_page(
+        self, key, loader, page_filter: Union[MatchQueryFilter, SummonerHistoryFilter]
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """
+        A cached page together with its ingest versions. They are read before the page,
+        so a change during the query shows up as a newer version.
+        """
+
+        async def load():
+            versions = await self.get_page_versions(page_filter)
+            documents = await loader()
+            return (documents, versions) if documents else None
+
+        return await self.query_cache.get_or_load(
+            key, load, get_page_tags(page_filter)
+        ) or ([], None)
+
+    def invalidate_cached_matches(
+        self, matches: List[Dict[str, Any]], changed: bool = False
+    ):
+        """Drop cached pages that could contain the matches"""
+        tags = {ALL_MATCHES_TAG}
+        for match in matches:
+            tags.update(match["metadata"].get("participants", []))
+            if changed:
+                self.match_cache.invalidate_tags(
+                    [f"match:{match['metadata']['matchId']}"]
+                )
+        self.query_cache.invalidate_tags(tags)
+
+    async def update_participant_stats(self, matches: List[Dict[str, Any]]) -> bool:
+        try:
+            bulk_ops = [
+                UpdateOne(
+                    {"puuid": stats["puuid"], "matchId": stats["matchId"]},
+                    {"$set": stats},
+                    upsert=True,
+                )
+                for match in matches
+                for stats in build_participant_stats(match)
+            ]
+            if bulk_ops:
+                await self.participant_stats_collection.bulk_write(
+                    bulk_ops, ordered=False
+                )
+            return True
+        except Exception as error:
+            print("Error updating participant stats in MongoDB: ", error)
+            return False
+
+    async def replace_collection(
+        self, collection, documents: AsyncIterator[Any], batch_size: int = 500
+    ):
+        """
+        Writes the documents (dicts or UpdateOne) to a temporary collection and replaces
+        the collection with it in one step. $out keeps the indexes of the collection and
+        readers see the old documents until it is replaced. Writes to the collection
+        during the rebuild are lost, so ingestion should be paused.
+        """
+        temporary = self.database.get_collection(f"{collection.name}{REBUILD_SUFFIX}")
+        await temporary.drop()
+        try:
+            # the summoner_stats upserts look up their document by its unique index
+            specs = [
+                spec
+                for spec in build_index_registry()
+                if spec.collection == collection.name
+            ]
+            if specs:
+                await temporary.create_indexes(
+                    [
+                        IndexModel(spec.keys, name=spec.name, unique=spec.unique)
+                        for spec in specs
+                    ]
+                )
+            batch = []
+            async for document in documents:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    await self._write_rebuild_batch(temporary, batch)
+                    batch = []
+            await self._write_rebuild_batch(temporary, batch)
+            await temporary.aggregate([{"$out": collection.name}]).to_list(length=None)
+        finally:
+            await temporary.drop()
+
+    @staticmethod
+    async def _write_rebuild_batch(collection, batch: List[Any]):
+        if not batch:
+            return
+        if isinstance(batch[0], UpdateOne):
+            await collection.bulk_write(batch, ordered=False)
+        else:
+            await collection.insert_many(batch, ordered=False)
+
+    async def rebuild_participant_stats(self, batch_size: int = 500):
+        """Derive participant_stats from every stored match, e.g. after adding fields"""
+        # only the fields that end up in participant_stats are read from the matches
+        projection = {
+            "_id": 0,
+            "metadata.matchId": 1,
+            **{f"info.{field}": 1 for field in PARTICIPANT_STATS_INFO_FIELDS},
+            **{f"info.participants.{field}": 1 for field in PARTICIPANT_STATS_FIELDS},
+        }
+
+        async def documents():
+            async for match in self.match_collection.find(
+                {}, projection, batch_size=batch_size
+            ):
+                for stats in build_participant_stats(match):
+                    yield stats
+
+        await self.replace_collection(
+            self.participant_stats_collection, documents(), batch_size
+        )
+        # every /history page may have changed
+        await self.ingest_version_collection.update_one(
+            {"_id": REBUILD_VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True
+        )
+        print("Rebuilt participant stats")
+
+    async def update_summoner_stats(self, matches: List[Dict[str, Any]]) -> bool:
+        """Add new matches to the summoner totals, each match must only be added once"""
+        try:
+            bulk_ops = [
+                build_summoner_stats_update(stats)
+                for match in matches
+                for stats in build_participant_stats(match)
+            ]
+            if bulk_ops:
+                await self.summoner_stats_collection.bulk_write(bulk_ops, ordered=False)
+            return True
+        except Exception as error:
+            print("Error updating summoner stats in MongoDB: ", error)
+            return False
+
+    async def rebuild_summoner_stats(self, batch_size: int = 500):
+        """Recount summoner_stats from participant_stats, e.g. after a failed update"""
+
+        async def documents():
+            async for stats in self.participant_stats_collection.find(
+                {}, {"_id": 0}, batch_size=batch_size
+            ):
+                yield build_summoner_stats_update(stats)
+
+        await self.replace_collection(
+            self.summoner_stats_collection, documents(), batch_size
+        )
+        print("Rebuilt summoner stats")
+
+    async def get_summoner_stats(
+        self, stats_filter: SummonerStatsFilter
+    ) -> List[Dict[str, Any]]:
+        try:
+            db_filter: Dict[str, Any] = {"puuid": stats_filter.puuid}
+            if stats_filter.queue != -1:
+                db_filter["queueId"] = stats_filter.queue
+            if stats_filter.champion != -1:
+                db_filter["championId"] = stats_filter.champion
+            if stats_filter.patch:
+                db_filter["patch"] = stats_filter.patch
+            return await self.summoner_stats_collection.find(
+                db_filter, {"_id": 0}, sort=[("games", -1)]
+            ).to_list(length=None)
+        except Exception as error:
+            print(
+                f"Error getting Stats of Summoner [{stats_filter.puuid}] with MongoDB: {error}"
+            )
+            return []
+
     async def get_matches_v5(self, match_filter: MatchQueryFilter) -> List[MatchV5DTO]:
+        if match_filter.match_id:
+            # finished matches never change, so they are cached without expiry
+            return await self.match_cache.get_or_load(
+                ("matches", match_filter.model_dump_json()),
+                lambda: self._find_matches_v5(match_filter),
+                [f"match:{match_filter.match_id}"],
+            )
+        documents, _ = await self.get_matches_page(match_filter)
+        return documents
+
+    async def get_matches_page(
+        self, match_filter: MatchQueryFilter
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """A /matches page and the ingest versions it was read at"""
+        return await self._get_versioned_page(
+            ("matches", get_page_key(match_filter)),
+            lambda: self._find_matches_v5(match_filter),
+            match_filter,
+        )
+
+    async def _find_matches_v5(
+        self, match_filter: MatchQueryFilter
+    ) -> List[MatchV5DTO]:
         try:
             db_filter = parse_filter_to_dict(match_filter)
             print(f"Getting Match data from DB [{db_filter}]")
 
             cursor = (
-                self.match_collection.find(db_filter, {"_id": 0})
-                .skip(match_filter.offset)
+                self.match_collection.find(
+                    db_filter, parse_fields_to_projection(match_filter)
+                )
+                .sort([("info.gameCreation", -1), ("metadata.matchId", -1)])
+                .skip(0 if match_filter.cursor else match_filter.offset)
                 .limit(match_filter.limit)
             )
             return await cursor.to_list(length=None)
@@ -177,34 +1037,91 @@ class DBHelper:
             print("Error getting MatchArchive with MongoDB: ", error)
             return []
 
+    async def stream_matches(
+        self, export_filter: MatchExportFilter, batch_size: int = EXPORT_BATCH_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """All matches of the filter in ascending matchId order, read batch by batch"""
+        db_filter = parse_filter_to_dict(
+            export_filter.model_copy(update={"cursor": ""})
+        )
+        if export_filter.after:
+            db_filter = {
+                "$and": [db_filter, {"metadata.matchId": {"$gt": export_filter.after}}]
+            }
+        print(f"Exporting Match data from DB [{db_filter}]")
+        cursor = self.match_collection.find(
+            db_filter,
+            parse_fields_to_projection(export_filter),
+            sort=[("metadata.matchId", 1)],
+            batch_size=batch_size,
+        )
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            await cursor.close()
+
+    async def stream_matches_by_id(
+        self,
+        after_id: Optional[ObjectId],
+        before_id: ObjectId,
+        batch_size: int = EXPORT_BATCH_SIZE,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Matches in insertion order by their _id, which is included in the documents"""
+        id_filter: Dict[str, Any] = {"$lt": before_id}
+        if after_id is not None:
+            id_filter["$gt"] = after_id
+        cursor = self.match_collection.find(
+            {"_id": id_filter}, sort=[("_id", 1)], batch_size=batch_size
+        )
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            await cursor.close()
+
+    async def get_export_state(self, name: str) -> Optional[Dict[str, Any]]:
+        """Empty for a new export, None if the state could not be read"""
+        try:
+            return await self.export_state_collection.find_one({"_id": name}) or {}
+        except Exception as error:
+            print(f"Error getting the state of Export [{name}] with MongoDB: {error}")
+            return None
+
+    async def update_export_state(self, name: str, fields: Dict[str, Any]) -> bool:
+        try:
+            await self.export_state_collection.update_one(
+                {"_id": name}, {"$set": fields}, upsert=True
+            )
+            return True
+        except Exception as error:
+            print(f"Error updating the state of Export [{name}] in MongoDB: {error}")
+            return False
+
     async def get_summoner_match_history(
         self, history_filter: SummonerHistoryFilter
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """A /history page and the ingest versions it was read at"""
+        return await self._get_versioned_page(
+            ("history", get_page_key(history_filter)),
+            lambda: self._find_summoner_match_history(history_filter),
+            history_filter,
+        )
+
+    async def _find_summoner_match_history(
+        self, history_filter: SummonerHistoryFilter
     ) -> List[Dict[str, Any]]:
         try:
-
             db_filter = parse_filter_to_dict(history_filter)
             print(f"Getting Summoner History data from DB [{db_filter}]")
-            agg = [
-                {"$match": db_filter},
-                {"$sort": {"info.gameCreation": -1}},
-                {"$skip": history_filter.offset},
-                {"$limit": history_filter.limit},
-                {
-                    "$set": {
-                        "info.participants": {
-                            "$filter": {
-                                "input": "$info.participants",
-                                "as": "participant",
-                                "cond": {
-                                    "$eq": ["$$participant.puuid", history_filter.puuid]
-                                },
-                            }
-                        }
-                    }
-                },
-                {"$project": {"_id": 0}},
-            ]
-            cursor = self.match_collection.aggregate(agg)
+            cursor = (
+                self.participant_stats_collection.find(
+                    db_filter, parse_fields_to_projection(history_filter)
+                )
+                .sort([("gameCreation", -1), ("matchId", -1)])
+                .skip(0 if history_filter.cursor else history_filter.offset)
+                .limit(history_filter.limit)
+            )
             return await cursor.to_list(length=None)
         except Exception as error:
             print(
@@ -212,8 +1129,123 @@ class DBHelper:
             )
             return []
 
+    async def get_lane_matchups(
+        self, lane_filter: LaneDiffFilter
+    ) -> List[Dict[str, Any]]:
+        """
+        The last games of a summoner with their participantId and the one of the lane
+        opponent, who played the same teamPosition in the other team
+        """
+        try:
+            db_filter: Dict[str, Any] = {
+                "puuid": lane_filter.puuid,
+                "teamPosition": {"$nin": ["", None]},
+            }
+            if lane_filter.queue != -1:
+                db_filter["queueId"] = lane_filter.queue
+            games = await self.participant_stats_collection.find(
+                db_filter,
+                {
+                    "_id": 0,
+                    "matchId": 1,
+                    "participantId": 1,
+                    "teamId": 1,
+                    "teamPosition": 1,
+                },
+                sort=[("gameCreation", -1), ("matchId", -1)],
+                limit=lane_filter.limit,
+            ).to_list(length=None)
+
+            opponents = await self.participant_stats_collection.find(
+                {
+                    "matchId": {"$in": [game["matchId"] for game in games]},
+                    "puuid": {"$ne": lane_filter.puuid},
+                },
+                {
+                    "_id": 0,
+                    "matchId": 1,
+                    "participantId": 1,
+                    "teamId": 1,
+                    "teamPosition": 1,
+                },
+            ).to_list(length=None)
+            # the other team's participant on the same position
+            opponent_ids = {
+                (
+                    opponent["matchId"],
+                    opponent["teamId"],
+                    opponent.get("teamPosition"),
+                ): opponent["participantId"]
+                for opponent in opponents
+            }
+
+            matchups = []
+            for game in games:
+                other_team = 200 if game["teamId"] == 100 else 100
+                opponent_id = opponent_ids.get(
+                    (game["matchId"], other_team, game["teamPosition"])
+                )
+                if opponent_id:
+                    matchups.append(
+                        {
+                            "matchId": game["matchId"],
+                            "participantId": game["participantId"],
+                            "opponentId": opponent_id,
+                        }
+                    )
+            return matchups
+        except Exception as error:
+            print(
+                f"Error getting lane matchups of Summoner [{lane_filter.puuid}] with MongoDB: {error}"
+            )
+            return []
+
+    async def get_timelines(
+        self, match_ids: List[str], events: bool = False
+    ) -> List[Dict[str, Any]]:
+        try:
+            projection = {"_id": 0} if events else {"_id": 0, "events": 0}
+            return await self.timeline_collection.find(
+                {"matchId": {"$in": match_ids}}, projection
+            ).to_list(length=None)
+        except Exception as error:
+            print("Error getting Timelines with MongoDB: ", error)
+            return []
+
+    async def get_recent_game_creations(
+        self, puuids: List[str], limit: int = 100
+    ) -> Dict[str, List[int]]:
+        """gameCreation of the newest stored matches of each summoner"""
+
+        async def get_creations(puuid: str) -> List[int]:
+            # covered by the (puuid, gameCreation) index of participant_stats
+            cursor = (
+                self.participant_stats_collection.find(
+                    {"puuid": puuid}, {"_id": 0, "gameCreation": 1}
+                )
+                .sort("gameCreation", -1)
+                .limit(limit)
+            )
+            return [
+                stats["gameCreation"]
+                for stats in await cursor.to_list(length=None)
+                if stats.get("gameCreation")
+            ]
+
+        try:
+            creations = await asyncio.gather(*[get_creations(p) for p in puuids])
+            return dict(zip(puuids, creations))
+        except Exception as error:
+            print("Error getting recent game creations with MongoDB: ", error)
+            return {}
+
     async def get_summoners(
-        self, name: str = "", puuid: str = "", skip: int = 0, limit: int = 25
+        self,
+        name: str = "",
+        puuid: str = "",
+        skip: int = 0,
+        limit: int = 25,
+        puuids: Optional[List[str]] = None,
     ) -> List[SummonerDTO]:
         try:
             db_filter: Dict[str, Any] = {}
@@ -221,6 +1253,8 @@ class DBHelper:
                 db_filter["name"] = name
             if puuid:
                 db_filter["puuid"] = puuid
+            if puuids is not None:
+                db_filter["puuid"] = {"$in": puuids}
             print(f"Getting Summoner data from DB")
 
             cursor = (
@@ -235,8 +1269,13 @@ class DBHelper:
 
     async def update_summoners(self, summoners: List[SummonerDTO]) -> bool:
         try:
+            # fields missing in the riot response must not overwrite stored ones
             bulk_ops = [
-                UpdateOne({"puuid": summoner["puuid"]}, {"$set": summoner}, upsert=True)
+                UpdateOne(
+                    {"puuid": summoner.puuid},
+                    {"$set": summoner.model_dump(exclude_none=True)},
+                    upsert=True,
+                )
                 for summoner in summoners
             ]
 
@@ -249,10 +1288,356 @@ class DBHelper:
             print("Error uploading summoners to MongoDB: ", error)
             return False
 
+    async def update_mastery(
+        self, puuid: str, masteries: List[ChampionMasteryDTO]
+    ) -> int:
+        """
+        Store a mastery snapshot of a summoner. Only champions that changed since the
+        last snapshot are added to mastery_history and updated in the latest view.
+        Returns the number of changed champions.
+        """
+        if not masteries:
+            return 0
+        try:
+            latest = {
+                mastery["championId"]: mastery
+                for mastery in await self.mastery_collection.find(
+                    {"puuid": puuid},
+                    {
+                        "_id": 0,
+                        "championId": 1,
+                        **dict.fromkeys(MASTERY_DELTA_FIELDS, 1),
+                    },
+                ).to_list(length=None)
+            }
+            snapshot_time = int(time.time() * 1000)
+            changed = []
+            for mastery in masteries:
+                document = mastery.model_dump(by_alias=True, exclude_none=True)
+                previous = latest.get(mastery.championId, {})
+                if any(
+                    document.get(field) != previous.get(field)
+                    for field in MASTERY_DELTA_FIELDS
+                ):
+                    changed.append({**document, "puuid": puuid})
+            if not changed:
+                return 0
+
+            await self.mastery_history_collection.insert_many(
+                [
+                    {
+                        "puuid": puuid,
+                        "championId": document["championId"],
+                        "snapshotTime": snapshot_time,
+                        **{
+                            field: document.get(field) for field in MASTERY_DELTA_FIELDS
+                        },
+                    }
+                    for document in changed
+                ],
+                ordered=False,
+            )
+            await self.mastery_collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"puuid": puuid, "championId": document["championId"]},
+                        {"$set": {**document, "snapshotTime": snapshot_time}},
+                        upsert=True,
+                    )
+                    for document in changed
+                ],
+                ordered=False,
+            )
+            print(f"Stored {len(changed)} changed masteries of Summoner [{puuid}]")
+            return len(changed)
+        except Exception as error:
+            print(f"Error updating mastery of Summoner [{puuid}] in MongoDB: {error}")
+            return 0
+
+    async def get_mastery(self, puuid: str) -> List[Dict[str, Any]]:
+        try:
+            return await self.mastery_collection.find(
+                {"puuid": puuid}, {"_id": 0}, sort=[("championPoints", -1)]
+            ).to_list(length=None)
+        except Exception as error:
+            print(f"Error getting mastery of Summoner [{puuid}] with MongoDB: {error}")
+            return []
+
+    async def get_match_creation_bounds(
+        self, puuids: List[str]
+    ) -> Dict[str, Dict[str, int]]:
+        """Oldest and newest gameCreation of the stored matches of each summoner"""
+        try:
+            if not puuids:
+                return {}
+            agg = [
+                {"$match": {"puuid": {"$in": puuids}}},
+                {
+                    "$group": {
+                        "_id": "$puuid",
+                        "oldest": {"$min": "$gameCreation"},
+                        "newest": {"$max": "$gameCreation"},
+                    }
+                },
+            ]
+            cursor = self.participant_stats_collection.aggregate(agg)
+            return {
+                bounds["_id"]: {"oldest": bounds["oldest"], "newest": bounds["newest"]}
+                for bounds in await cursor.to_list(length=None)
+            }
+        except Exception as error:
+            print("Error getting match creation bounds with MongoDB: ", error)
+            return {}
+
+    async def get_game_creations(
+        self, match_ids: List[str]
+    ) -> Optional[Dict[str, int]]:
+        """gameCreation of the stored matches by matchId, None if the query failed"""
+        try:
+            if not match_ids:
+                return {}
+            cursor = self.match_collection.find(
+                {"metadata.matchId": {"$in": match_ids}},
+                {"_id": 0, "metadata.matchId": 1, "info.gameCreation": 1},
+            )
+            return {
+                match["metadata"]["matchId"]: match["info"]["gameCreation"]
+                for match in await cursor.to_list(length=None)
+            }
+        except Exception as error:
+            print("Error getting game creations with MongoDB: ", error)
+            return None
+
+    async def add_timeline_backlog(self, match_ids: List[str]) -> bool:
+        """Remember stored matches without a timeline, they are fetched later"""
+        try:
+            if not match_ids:
+                return True
+            now = int(time.time() * 1000)
+            await self.timeline_backlog_collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"matchId": match_id},
+                        {"$setOnInsert": {"attempts": 0, "retryAt": now}},
+                        upsert=True,
+                    )
+                    for match_id in match_ids
+                ],
+                ordered=False,
+            )
+            return True
+        except Exception as error:
+            print("Error adding matches to the timeline backlog in MongoDB: ", error)
+            return False
+
+    async def seed_timeline_backlog(self):
+        """
+        Adds every stored match without a timeline to the backlog, e.g. the matches
+        stored before timelines existed. Scans all matches, so it only runs on demand.
+        """
+        now = int(time.time() * 1000)
+        await self.match_collection.aggregate(
+            [
+                {"$project": {"_id": 0, "matchId": "$metadata.matchId"}},
+                {
+                    "$lookup": {
+                        "from": "timeline_v5",
+                        "localField": "matchId",
+                        "foreignField": "matchId",
+                        "pipeline": [{"$project": {"_id": 1}}],
+                        "as": "timeline",
+                    }
+                },
+                {"$match": {"timeline": {"$size": 0}}},
+                {"$project": {"matchId": 1, "attempts": {"$literal": 0}}},
+                {"$set": {"retryAt": now}},
+                {
+                    "$merge": {
+                        "into": "timeline_backlog",
+                        "on": "matchId",
+                        "whenMatched": "keepExisting",
+                        "whenNotMatched": "insert",
+                    }
+                },
+            ]
+        ).to_list(length=None)
+        print("Seeded the timeline backlog")
+
+    async def get_timeline_backlog(self, limit: int = 100) -> List[str]:
+        """Matches whose timeline fetch is due, the longest waiting first"""
+        try:
+            cursor = (
+                self.timeline_backlog_collection.find(
+                    {"retryAt": {"$lte": int(time.time() * 1000)}},
+                    {"_id": 0, "matchId": 1},
+                )
+                .sort("retryAt", 1)
+                .limit(limit)
+            )
+            return [entry["matchId"] for entry in await cursor.to_list(length=None)]
+        except Exception as error:
+            print("Error getting the timeline backlog with MongoDB: ", error)
+            return []
+
+    async def update_timeline_backlog(
+        self, fetched_ids: List[str], failed_ids: List[str]
+    ) -> bool:
+        """Drop the fetched matches and back off the retries of the failed ones"""
+        try:
+            if fetched_ids:
+                await self.timeline_backlog_collection.delete_many(
+                    {"matchId": {"$in": fetched_ids}}
+                )
+            if failed_ids:
+                now = int(time.time() * 1000)
+                await self.timeline_backlog_collection.update_many(
+                    {"matchId": {"$in": failed_ids}},
+                    [
+                        {"$set": {"attempts": {"$add": ["$attempts", 1]}}},
+                        {
+                            "$set": {
+                                "retryAt": {
+                                    "$cond": [
+                                        {"$lt": ["$attempts", TIMELINE_MAX_ATTEMPTS]},
+                                        {
+                                            "$add": [
+                                                now,
+                                                {
+                                                    "$multiply": [
+                                                        TIMELINE_RETRY_DELAY,
+                                                        {"$pow": [2, "$attempts"]},
+                                                    ]
+                                                },
+                                            ]
+                                        },
+                                        "$$REMOVE",
+                                    ]
+                                }
+                            }
+                        },
+                    ],
+                )
+            return True
+        except Exception as error:
+            print("Error updating the timeline backlog in MongoDB: ", error)
+            return False
+
+    async def update_summoner_match_sync(
+        self, match_sync: Dict[str, Dict[str, Any]]
+    ) -> bool:
+        """
+        Store the match sync cursor fields (newest, oldest, gapEnd, gapNewest,
+        backfillComplete) per puuid, fields set to None are removed
+        """
+        try:
+            if not match_sync:
+                return True
+            bulk_ops = []
+            for puuid, fields in match_sync.items():
+                update: Dict[str, Dict[str, Any]] = {}
+                for key, value in fields.items():
+                    if value is None:
+                        update.setdefault("$unset", {})[f"matchSync.{key}"] = ""
+                    else:
+                        update.setdefault("$set", {})[f"matchSync.{key}"] = value
+                if update:
+                    bulk_ops.append(UpdateOne({"puuid": puuid}, update))
+            if bulk_ops:
+                await self.summoner_collection.bulk_write(bulk_ops, ordered=False)
+            return True
+        except Exception as error:
+            print("Error updating summoner match sync with MongoDB: ", error)
+            return False
+
+    async def register_jobs(self, jobs: List[Dict[str, Any]]) -> bool:
+        """
+        Create missing jobs and update the settings of existing ones without touching
+        their schedule, jobs that are no longer registered are removed
+        """
+        try:
+            bulk_ops: List[Any] = [
+                UpdateOne(
+                    {"jobId": job["jobId"]},
+                    {
+                        "$set": {
+                            key: value
+                            for key, value in job.items()
+                            if key in ("kind", "target", "priority", "interval")
+                        },
+                        "$setOnInsert": {"nextRun": job["nextRun"]},
+                    },
+                    upsert=True,
+                )
+                for job in jobs
+            ]
+            bulk_ops.append(
+                DeleteMany({"jobId": {"$nin": [job["jobId"] for job in jobs]}})
+            )
+            result = await self.job_collection.bulk_write(bulk_ops)
+            print(
+                f"Registered {result.upserted_count} new jobs and removed {result.deleted_count} jobs"
+            )
+            return True
+        except Exception as error:
+            print("Error registering jobs in MongoDB: ", error)
+            return False
+
+    async def get_due_jobs(self, now: float) -> List[Dict[str, Any]]:
+        try:
+            cursor = self.job_collection.find(
+                {"nextRun": {"$lte": now}}, {"_id": 0}
+            ).sort("priority", -1)
+            return await cursor.to_list(length=None)
+        except Exception as error:
+            print("Error getting due jobs with MongoDB: ", error)
+            return []
+
+    async def get_next_job_run(self) -> Optional[float]:
+        try:
+            job = await self.job_collection.find_one(
+                {}, {"_id": 0, "nextRun": 1}, sort=[("nextRun", 1)]
+            )
+            return job["nextRun"] if job else None
+        except Exception as error:
+            print("Error getting next job run with MongoDB: ", error)
+            return None
+
+    async def update_job_runs(self, jobs: List[Dict[str, Any]]) -> bool:
+        try:
+            if not jobs:
+                return True
+            bulk_ops = [
+                UpdateOne(
+                    {"jobId": job["jobId"]},
+                    {
+                        "$set": {
+                            "nextRun": job["nextRun"],
+                            "lastRun": job["lastRun"],
+                            "lastStatus": job["lastStatus"],
+                        }
+                    },
+                )
+                for job in jobs
+            ]
+            await self.job_collection.bulk_write(bulk_ops, ordered=False)
+            return True
+        except Exception as error:
+            print("Error updating job runs in MongoDB: ", error)
+            return False
+
 
 async def main():
     dbh = DBHelper()
     await dbh.init_indexes()
+    # these scan every stored match, they only run when asked for, e.g.
+    # python -m helpers.DBHelper rebuild-stats
+    if "rebuild-stats" in sys.argv[1:]:
+        await dbh.rebuild_participant_stats()
+        await dbh.rebuild_summoner_stats()
+    if "seed-timeline-backlog" in sys.argv[1:]:
+        await dbh.seed_timeline_backlog()
+    if "index-usage" in sys.argv[1:]:
+        await dbh.print_index_usage()
 
 
 if __name__ == "__main__":
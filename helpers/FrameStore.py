@@ -0,0 +1,109 @@
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+from bson import Binary
+
+# series of the participant frames, positions are split into x and y
+FRAME_FIELDS = [
+    "totalGold",
+    "currentGold",
+    "xp",
+    "level",
+    "minionsKilled",
+    "jungleMinionsKilled",
+    "x",
+    "y",
+]
+FRAME_DTYPE = np.dtype("<i4")
+LANE_DIFF_FIELDS = ["totalGold", "xp", "minionsKilled"]
+
+
+def frame_value(participant_frame: Dict[str, Any], field: str) -> int:
+    if field in ["x", "y"]:
+        return (participant_frame.get("position") or {}).get(field) or 0
+    return participant_frame.get(field) or 0
+
+
+def pack_frames(participant_frames: List[List[Dict[str, Any]]]) -> Binary:
+    """
+    Packs the frames of every participant into one int32 array with the shape
+    (participants, FRAME_FIELDS, frames), missing values are stored as 0
+    """
+    frames = np.array(
+        [
+            [
+                [frame_value(participant_frame, field) for participant_frame in series]
+                for field in FRAME_FIELDS
+            ]
+            for series in participant_frames
+        ],
+        dtype=FRAME_DTYPE,
+    )
+    return Binary(frames.tobytes())
+
+
+def unpack_frames(timeline: Dict[str, Any]) -> np.ndarray:
+    shape = (
+        len(timeline["participants"]),
+        len(timeline["frameFields"]),
+        len(timeline["timestamps"]),
+    )
+    return np.frombuffer(timeline["frames"], dtype=FRAME_DTYPE).reshape(shape)
+
+
+def lane_diffs(
+    timelines: List[Dict[str, Any]],
+    player_ids: Sequence[int],
+    opponent_ids: Sequence[int],
+    minutes: Sequence[int],
+    fields: Sequence[str] = LANE_DIFF_FIELDS,
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Average difference between the player and the lane opponent at the given minutes
+    over all games. Games that ended before a minute don't count for it, games where
+    the timeline misses one of the two don't count at all.
+    """
+    minute_ms = np.array(minutes, dtype=np.int64) * 60 * 1000
+    # games x (player, opponent) x fields x minutes
+    values = np.full((len(timelines), 2, len(fields), len(minutes)), np.nan)
+    for game, timeline in enumerate(timelines):
+        frames = unpack_frames(timeline)
+        field_indexes = [timeline["frameFields"].index(field) for field in fields]
+        participant_indexes = {
+            participant["participantId"]: index
+            for index, participant in enumerate(timeline["participants"])
+        }
+        if (
+            player_ids[game] not in participant_indexes
+            or opponent_ids[game] not in participant_indexes
+        ):
+            continue
+        rows = [
+            participant_indexes[player_ids[game]],
+            participant_indexes[opponent_ids[game]],
+        ]
+        frame_indexes = minute_ms // (timeline.get("frameInterval") or 60000)
+        # the last frame is taken when the game ends, it only counts for the minutes
+        # the game reached
+        timestamps = np.array(timeline["timestamps"], dtype=np.int64)
+        valid = (frame_indexes >= 0) & (frame_indexes < len(timestamps))
+        valid[valid] = timestamps[frame_indexes[valid]] >= minute_ms[valid]
+        values[game][:, :, valid] = frames[np.ix_(rows, field_indexes)][
+            :, :, frame_indexes[valid]
+        ]
+
+    diffs = values[:, 0] - values[:, 1]
+    games = np.count_nonzero(~np.isnan(diffs[:, 0, :]), axis=0)
+    means = np.nansum(diffs, axis=0) / np.maximum(games, 1)
+    return {
+        minute: {
+            "games": int(games[index]),
+            **{
+                field: round(float(means[field_index, index]), 1)
+                if games[index]
+                else None
+                for field_index, field in enumerate(fields)
+            },
+        }
+        for index, minute in enumerate(minutes)
+    }
@@ -0,0 +1,118 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import BaseModel
+from pymongo import IndexModel
+
+IndexKeys = List[Tuple[str, int]]
+
+
+class IndexSpec(BaseModel):
+    collection: str
+    keys: IndexKeys
+    unique: bool = False
+
+    @property
+    def name(self) -> str:
+        # same naming as mongodb uses for indexes created without a name
+        return "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+
+def sample_value(annotation: Any) -> Any:
+    """A value that makes a filter field show up in the parsed filter"""
+    if annotation is int:
+        return 0
+    if annotation is bool:
+        return True
+    if getattr(annotation, "__origin__", None) is list:
+        return ["sample"]
+    return "sample"
+
+
+def derive_filter_indexes(
+    filter_cls: Type[BaseModel],
+    parse_filter: Callable[[Any], Dict[str, Any]],
+    collection: str,
+    sort_keys: IndexKeys,
+    anchor: Optional[str] = None,
+    ignored_fields: Iterable[str] = (),
+) -> List[IndexSpec]:
+    """
+    Indexes for every query shape of a filter model: each filter field is queried by
+    equality followed by the sort of the pages. With an anchor (e.g. the puuid of the
+    history) the anchor field is put in front of every index.
+    """
+
+    def filter_keys(*fields: str) -> IndexKeys:
+        filter_obj = filter_cls(
+            **{
+                field: sample_value(filter_cls.model_fields[field].annotation)
+                for field in fields
+            }
+        )
+        return [(key, 1) for key in parse_filter(filter_obj) if not key.startswith("$")]
+
+    anchor_keys = filter_keys(anchor) if anchor else []
+    specs = [IndexSpec(collection=collection, keys=anchor_keys + sort_keys)]
+    for field in filter_cls.model_fields:
+        if field == anchor or field in ignored_fields:
+            continue
+        if anchor:
+            keys = anchor_keys + [
+                key for key in filter_keys(anchor, field) if key not in anchor_keys
+            ]
+        else:
+            keys = filter_keys(field)
+        if keys:
+            specs.append(IndexSpec(collection=collection, keys=keys + sort_keys))
+    return specs
+
+
+class IndexManager:
+    """Reconciles the indexes of the database with a declarative registry"""
+
+    def __init__(self, database: AsyncIOMotorDatabase, registry: List[IndexSpec]):
+        self.database = database
+        self.registry: Dict[str, Dict[str, IndexSpec]] = {}
+        for spec in registry:
+            self.registry.setdefault(spec.collection, {})[spec.name] = spec
+
+    async def reconcile(self, drop_obsolete: bool = True):
+        for collection_name, specs in self.registry.items():
+            collection = self.database.get_collection(collection_name)
+            existing = await collection.index_information()
+
+            missing = [spec for name, spec in specs.items() if name not in existing]
+            if missing:
+                await collection.create_indexes(
+                    [
+                        IndexModel(spec.keys, name=spec.name, unique=spec.unique)
+                        for spec in missing
+                    ]
+                )
+                for spec in missing:
+                    print(f"Created index on {collection_name}.{spec.name}")
+
+            obsolete = [
+                name for name in existing if name not in specs and name != "_id_"
+            ]
+            for name in obsolete if drop_obsolete else []:
+                await collection.drop_index(name)
+                print(f"Dropped obsolete index on {collection_name}.{name}")
+
+    async def get_usage(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Operations served by each index since the server last restarted"""
+        usage: Dict[str, List[Dict[str, Any]]] = {}
+        for collection_name in self.registry:
+            cursor = self.database.get_collection(collection_name).aggregate(
+                [{"$indexStats": {}}]
+            )
+            usage[collection_name] = [
+                {
+                    "name": stats["name"],
+                    "ops": stats["accesses"]["ops"],
+                    "since": stats["accesses"]["since"],
+                }
+                for stats in await cursor.to_list(length=None)
+            ]
+        return usage
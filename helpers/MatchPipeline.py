@@ -0,0 +1,286 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Set
+
+from helpers.DBHelper import DBHelper
+from helpers.MatchWriteBuffer import MatchWriteBuffer
+from helpers.RiotHelper import DEFAULT_PLATFORM, RiotHelper
+
+
+class SyncCycle:
+    """Bookkeeping of one pipeline run, used to advance the sync cursors"""
+
+    def __init__(self):
+        self.queued_ids: Set[str] = set()
+        self.written = 0
+        self.failed_ids: Set[str] = set()
+        self.listed_ids: Dict[str, Set[str]] = {}
+        self.list_errors: Set[str] = set()
+        self.exhausted: Set[str] = set()
+        self.platforms: Dict[str, str] = {}
+
+
+class MatchPipeline:
+    """
+    Downloads missing matches concurrently. A producer queues the ids of matches that
+    are not in the database yet, a pool of workers fetches them from the Riot-API
+    (throttled only by the rate limiter) and a write buffer inserts them in batches.
+    The timelines of the matches are fetched and stored alongside them, matches whose
+    timeline could not be fetched go to the backlog of `backfill_timelines`.
+
+    Every summoner keeps a `matchSync` cursor with the gameCreation of its newest and
+    oldest stored match. Regular syncs only list matches newer than the cursor and
+    backfills continue below the oldest match until the history is exhausted. The
+    newest match only moves once the list reached the cursor, until then `gapEnd`
+    marks the oldest listed match and the following syncs list the gap below it.
+    """
+
+    def __init__(
+        self,
+        workers: int = 20,
+        batch_size: int = 50,
+        full_validation: bool = False,
+        timelines: bool = True,
+    ):
+        self.db_helper = DBHelper()
+        self.riot_helper = RiotHelper()
+        self.workers = workers
+        self.batch_size = batch_size
+        # by default only the indexed fields are validated and the raw match is stored
+        self.full_validation = full_validation
+        self.timelines = timelines
+        # matches queued by any running cycle and not yet stored
+        self.in_flight: Set[str] = set()
+
+    async def run(
+        self,
+        summoners: List[Dict[str, Any]],
+        count: int = 100,
+        pages: int = 1,
+        backfill: bool = False,
+    ) -> int:
+        id_queue: asyncio.Queue[Optional[str]] = asyncio.Queue(self.workers * 2)
+
+        cycle = SyncCycle()
+        cycle.platforms = {
+            summoner["puuid"]: summoner.get("platform") or DEFAULT_PLATFORM
+            for summoner in summoners
+        }
+
+        async def on_flush(documents: List[Dict[str, Any]], stored_ids: Set[str]):
+            for document in documents:
+                match_id = document["metadata"]["matchId"]
+                if match_id in stored_ids:
+                    cycle.written += 1
+                else:
+                    cycle.failed_ids.add(match_id)
+                self.in_flight.discard(match_id)
+
+        write_buffer = MatchWriteBuffer(self.batch_size, on_flush=on_flush)
+        fetchers = [
+            asyncio.create_task(self._fetch(id_queue, write_buffer, cycle))
+            for _ in range(self.workers)
+        ]
+        try:
+            cursors = await self._get_cursors(summoners)
+            await self._produce(cursors, count, pages, backfill, id_queue, cycle)
+            for _ in fetchers:
+                await id_queue.put(None)
+            await asyncio.gather(*fetchers)
+            await write_buffer.close()
+            await self._advance_cursors(cursors, backfill, cycle)
+            return cycle.written
+        finally:
+            for task in fetchers:
+                task.cancel()
+            self.in_flight.difference_update(cycle.queued_ids)
+
+    async def _get_cursors(
+        self, summoners: List[Dict[str, Any]]
+    ) -> Dict[str, Dict[str, Any]]:
+        cursors = {
+            summoner["puuid"]: dict(summoner.get("matchSync", {}))
+            for summoner in summoners
+        }
+        # summoners synced before the cursors existed start from their stored matches
+        missing = [puuid for puuid, cursor in cursors.items() if "newest" not in cursor]
+        bounds = await self.db_helper.get_match_creation_bounds(missing)
+        for puuid, puuid_bounds in bounds.items():
+            cursors[puuid].update(puuid_bounds)
+        return cursors
+
+    @staticmethod
+    def _list_params(cursor: Dict[str, Any], backfill: bool) -> Dict[str, int]:
+        # the match list takes epoch seconds, the cursors are gameCreation millis. The
+        # matches of a summoner don't overlap, so every older match ended at least a
+        # second before the match at the end bound was created.
+        if backfill:
+            if "oldest" in cursor:
+                return {"end_time": cursor["oldest"] // 1000 - 1}
+            return {}
+        params = {}
+        if "newest" in cursor:
+            params["start_time"] = cursor["newest"] // 1000
+        if "gapEnd" in cursor:
+            params["end_time"] = cursor["gapEnd"] // 1000 - 1
+        return params
+
+    async def _produce(
+        self,
+        cursors: Dict[str, Dict[str, Any]],
+        count: int,
+        pages: int,
+        backfill: bool,
+        id_queue: asyncio.Queue,
+        cycle: SyncCycle,
+    ):
+        # tracked summoners mostly play together, so their match lists are merged
+        # and every match is checked and downloaded once per cycle
+        active_puuids = [
+            puuid
+            for puuid, cursor in cursors.items()
+            if not (backfill and cursor.get("backfillComplete"))
+        ]
+        for page in range(pages):
+            if not active_puuids:
+                break
+            print(f"Updating Match Data for {len(active_puuids)} Summoners")
+            match_lists = await asyncio.gather(
+                *[
+                    self.riot_helper.get_match_list_riot(
+                        puuid,
+                        count,
+                        page * count,
+                        platform=cycle.platforms[puuid],
+                        **self._list_params(cursors[puuid], backfill),
+                    )
+                    for puuid in active_puuids
+                ]
+            )
+
+            page_ids: Set[str] = set()
+            next_puuids = []
+            for puuid, match_ids in zip(active_puuids, match_lists):
+                if match_ids is None:
+                    cycle.list_errors.add(puuid)
+                    continue
+                cycle.listed_ids.setdefault(puuid, set()).update(match_ids)
+                page_ids.update(match_ids)
+                if len(match_ids) == count:
+                    next_puuids.append(puuid)
+                else:
+                    cycle.exhausted.add(puuid)
+            active_puuids = next_puuids
+
+            filtered_ids = await self.db_helper.get_non_existing_match_ids(
+                list(page_ids - self.in_flight)
+            )
+            if len(filtered_ids) == 0:
+                print(f"No new matches on page [{page}]")
+            for match_id in filtered_ids:
+                self.in_flight.add(match_id)
+                cycle.queued_ids.add(match_id)
+                await id_queue.put(match_id)
+
+    async def _fetch(
+        self, id_queue: asyncio.Queue, write_buffer: MatchWriteBuffer, cycle: SyncCycle
+    ):
+        while True:
+            match_id = await id_queue.get()
+            if match_id is None:
+                return
+            if self.full_validation:
+                get_match = self.riot_helper.get_match_riot(match_id)
+            else:
+                get_match = self.riot_helper.get_match_raw_riot(match_id)
+            if self.timelines:
+                match, timeline = await asyncio.gather(
+                    get_match, self.riot_helper.get_timeline_riot(match_id)
+                )
+            else:
+                match, timeline = await get_match, None
+            if match:
+                if self.timelines and not timeline:
+                    print(f"Storing Match [{match_id}] without Timeline")
+                await write_buffer.add(match, timeline)
+            else:
+                cycle.failed_ids.add(match_id)
+                self.in_flight.discard(match_id)
+
+    async def backfill_timelines(self, limit: int = 100) -> int:
+        """
+        Fetches the due timelines of the backlog: failed timeline requests and matches
+        stored by the api or before timelines were stored
+        """
+        match_ids = await self.db_helper.get_timeline_backlog(limit)
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def fetch(match_id: str) -> Optional[Dict[str, Any]]:
+            async with semaphore:
+                return await self.riot_helper.get_timeline_riot(match_id)
+
+        results = await asyncio.gather(*[fetch(match_id) for match_id in match_ids])
+        timelines = [timeline for timeline in results if timeline]
+        if timelines and not await self.db_helper.insert_timelines(timelines):
+            return 0
+        await self.db_helper.update_timeline_backlog(
+            [match_id for match_id, timeline in zip(match_ids, results) if timeline],
+            [
+                match_id
+                for match_id, timeline in zip(match_ids, results)
+                if not timeline
+            ],
+        )
+        return len(timelines)
+
+    async def _advance_cursors(
+        self, cursors: Dict[str, Dict[str, Any]], backfill: bool, cycle: SyncCycle
+    ):
+        # a missed match has to be listed again, so the cursor stays where it is
+        complete = [
+            puuid
+            for puuid in cursors
+            if puuid not in cycle.list_errors
+            and not cycle.listed_ids.get(puuid, set()) & cycle.failed_ids
+        ]
+        # every listed match is stored now, either by this cycle or before it
+        creations = await self.db_helper.get_game_creations(
+            list(
+                set().union(*[cycle.listed_ids.get(puuid, set()) for puuid in complete])
+            )
+        )
+        if creations is None:
+            return
+
+        updates: Dict[str, Dict[str, Any]] = {}
+        for puuid in complete:
+            cursor = cursors[puuid]
+            listed_ids = cycle.listed_ids.get(puuid, set())
+            # a match that another cycle is still writing could fail there
+            if not listed_ids <= creations.keys():
+                continue
+            listed = [creations[match_id] for match_id in listed_ids]
+            exhausted = puuid in cycle.exhausted
+            fields: Dict[str, Any] = {}
+            if listed:
+                fields["oldest"] = min(listed + [cursor.get("oldest") or min(listed)])
+            if backfill:
+                if exhausted:
+                    fields["backfillComplete"] = True
+            else:
+                newest = max(
+                    listed + [cursor.get("newest") or 0, cursor.get("gapNewest") or 0]
+                )
+                if exhausted or "newest" not in cursor:
+                    # everything newer than the cursor has been listed
+                    if newest:
+                        fields["newest"] = newest
+                    if "gapEnd" in cursor:
+                        fields["gapEnd"] = None
+                        fields["gapNewest"] = None
+                elif listed:
+                    # older matches above the cursor are still missing, the next sync
+                    # only lists the gap below the oldest listed one
+                    fields["gapEnd"] = min(listed)
+                    fields["gapNewest"] = newest
+            updates[puuid] = fields
+        await self.db_helper.update_summoner_match_sync(updates)
@@ -0,0 +1,80 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Union
+
+from helpers.DBHelper import DBHelper, serialize_match
+from interfaces.MatchV5DTO import MatchV5DTO
+
+# called after every flush with the flushed documents and the ids that are stored
+FlushCallback = Callable[[List[Dict[str, Any]], Set[str]], Awaitable[None]]
+
+
+class MatchWriteBuffer:
+    """
+    Write-behind buffer for new matches. Matches are serialized once when they are
+    added and inserted in unordered batches, either when `max_batch` matches are
+    pending or `flush_interval` seconds after the first pending match arrived.
+    Timelines added with a match are stored in the same flush, stored matches without
+    one are added to the timeline backlog.
+    """
+
+    def __init__(
+        self,
+        max_batch: int = 50,
+        flush_interval: float = 5,
+        on_flush: Optional[FlushCallback] = None,
+    ):
+        self.db_helper = DBHelper()
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.pending: List[Dict[str, Any]] = []
+        self.pending_timelines: List[Dict[str, Any]] = []
+        self.flush_lock = asyncio.Lock()
+        self.timer: Optional[asyncio.Task] = None
+
+    async def add(
+        self,
+        match: Union[MatchV5DTO, Dict[str, Any]],
+        timeline: Optional[Dict[str, Any]] = None,
+    ):
+        self.pending.append(serialize_match(match))
+        if timeline:
+            self.pending_timelines.append(timeline)
+        if len(self.pending) >= self.max_batch:
+            # the caller waits for the flush, which throttles producers to the database
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self) -> Set[str]:
+        async with self.flush_lock:
+            if self.timer is not None and self.timer is not asyncio.current_task():
+                self.timer.cancel()
+                self.timer = None
+            documents, self.pending = self.pending, []
+            timelines, self.pending_timelines = self.pending_timelines, []
+            if not documents:
+                return set()
+            stored_ids = await self.db_helper.insert_matches(documents)
+            # a timeline of a failed match is rejected as duplicate when it's retried
+            await self.db_helper.insert_timelines(timelines)
+            timeline_ids = {timeline["metadata"]["matchId"] for timeline in timelines}
+            await self.db_helper.add_timeline_backlog(
+                [
+                    document["metadata"]["matchId"]
+                    for document in documents
+                    if document["metadata"]["matchId"] in stored_ids
+                    and document["metadata"]["matchId"] not in timeline_ids
+                ]
+            )
+            if self.on_flush:
+                await self.on_flush(documents, stored_ids)
+            return stored_ids
+
+    async def close(self):
+        await self.flush()
@@ -0,0 +1,91 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+
+def parse_rate_limit_header(value: str) -> List[Tuple[int, int]]:
+    """Parse a Riot header like `20:1,100:120` into (value, seconds) pairs."""
+    pairs = []
+    for part in value.split(","):
+        amount, _, seconds = part.strip().partition(":")
+        if amount.isdigit() and seconds.isdigit():
+            pairs.append((int(amount), int(seconds)))
+    return pairs
+
+
+class RateLimitWindow:
+    """Sliding window allowing at most `calls` requests per `period` seconds."""
+
+    def __init__(self, calls: int, period: float):
+        self.calls = calls
+        self.period = period
+        self.timestamps: Deque[float] = deque()
+
+    def _evict(self, now: float):
+        while self.timestamps and self.timestamps[0] <= now - self.period:
+            self.timestamps.popleft()
+
+    def wait_time(self, now: float) -> float:
+        self._evict(now)
+        # a limit of 0 (e.g. `0:10`) still lets one request through per period, its
+        # response reports the limits once they are raised again
+        calls = max(self.calls, 1)
+        if len(self.timestamps) < calls:
+            return 0.0
+        # the oldest request has to leave the window before a new one fits
+        return self.timestamps[len(self.timestamps) - calls] + self.period - now
+
+    def record(self, now: float):
+        self.timestamps.append(now)
+
+    def sync_count(self, count: int, now: float):
+        # the server saw more requests than we did (other processes, restarts)
+        self._evict(now)
+        missing = count - len(self.timestamps)
+        if missing > 0:
+            self.timestamps.extend([now] * missing)
+
+
+class RateLimiter:
+    """A set of windows that all have to allow a request before it is sent."""
+
+    def __init__(self, name: str, limits: Iterable[Tuple[int, float]] = ()):
+        self.name = name
+        self.windows: Dict[float, RateLimitWindow] = {
+            period: RateLimitWindow(calls, period) for calls, period in limits
+        }
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        window_wait = max(
+            (window.wait_time(now) for window in self.windows.values()), default=0.0
+        )
+        return max(window_wait, self.blocked_until - now)
+
+    def record(self, now: float):
+        for window in self.windows.values():
+            window.record(now)
+
+    def update_limits(self, limits: List[Tuple[int, int]]):
+        """Replace the windows with the limits reported by the server."""
+        if not limits:
+            return
+        periods = {period for _, period in limits}
+        for period in list(self.windows):
+            if period not in periods:
+                del self.windows[period]
+        for calls, period in limits:
+            window = self.windows.get(period)
+            if window is None:
+                self.windows[period] = RateLimitWindow(calls, period)
+            elif window.calls != calls:
+                print(f"Rate limit [{self.name}] changed to {calls}:{period}")
+                window.calls = calls
+
+    def sync_counts(self, counts: List[Tuple[int, int]], now: float):
+        for count, period in counts:
+            window = self.windows.get(period)
+            if window:
+                window.sync_count(count, now)
+
+    def block(self, seconds: float, now: float):
+        self.blocked_until = max(self.blocked_until, now + seconds)
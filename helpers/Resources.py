@@ -0,0 +1,48 @@
+import asyncio
+from typing import List, Optional
+
+from helpers.DBHelper import DBHelper
+from helpers.RiotHelper import DEFAULT_PLATFORM, RiotHelper
+
+
+class Resources:
+    """
+    Opens the shared MongoDB and Riot-API clients once, warms their connections and
+    closes them again. Used by the API lifespan and as `async with` by the tasks.
+    """
+
+    def __init__(self, platforms: Optional[List[str]] = None):
+        self.platforms = platforms or [DEFAULT_PLATFORM]
+        self.db_helper: Optional[DBHelper] = None
+        self.riot_helper: Optional[RiotHelper] = None
+
+    async def open(self):
+        self.db_helper = DBHelper()
+        self.riot_helper = RiotHelper()
+        # the helpers are shared, a previous close left their clients closed
+        if not self.db_helper.connected:
+            self.db_helper.connect()
+        if self.riot_helper.client.is_closed:
+            self.riot_helper.connect()
+        # a failed warmup only costs the latency of the first requests
+        results = await asyncio.gather(
+            self.db_helper.warmup(),
+            self.riot_helper.warmup(self.platforms),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print("Error warming up connections: ", result)
+
+    async def close(self):
+        if self.riot_helper:
+            await self.riot_helper.disconnect()
+        if self.db_helper:
+            await self.db_helper.disconnect()
+
+    async def __aenter__(self) -> "Resources":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
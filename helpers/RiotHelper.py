@@ -1,19 +1,100 @@
 import asyncio
 import os
+import time
 from threading import Lock
-from typing import List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import httpx
 from dotenv import load_dotenv
-from ratelimit import limits, sleep_and_retry
 
+from helpers.RateLimiter import RateLimiter, parse_rate_limit_header
 from interfaces.AccountDTO import AccountDTO
 from interfaces.ChampionMasteryDTO import ChampionMasteryDTO
+from interfaces.MatchSkeletonDTO import MatchSkeletonDTO
 from interfaces.MatchV5DTO import MatchV5DTO
 from interfaces.SummonerDTO import SummonerDTO
+from interfaces.TimelineDTO import Metadata as TimelineMetadata
+
+# Retries for rate limited (429) and failed (5xx) requests
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+# Limits of a development key until the server reports the real ones
+APP_RATE_LIMITS = [(20, 1), (100, 120)]
+# Connection pool of the HTTP client, can be overridden in the environment
+RIOT_MAX_CONNECTIONS = 100
+RIOT_MAX_KEEPALIVE_CONNECTIONS = 20
+RIOT_KEEPALIVE_EXPIRY = 30
+RIOT_TIMEOUT = 10
+RIOT_CONNECT_TIMEOUT = 5
+# Platform of summoners without a stored one
+DEFAULT_PLATFORM = "euw1"
+# Regional routing value of every platform, used by match-v5 and account-v1
+PLATFORM_REGIONS = {
+    "br1": "americas",
+    "la1": "americas",
+    "la2": "americas",
+    "na1": "americas",
+    "eun1": "europe",
+    "euw1": "europe",
+    "me1": "europe",
+    "ru": "europe",
+    "tr1": "europe",
+    "jp1": "asia",
+    "kr": "asia",
+    "oc1": "sea",
+    "ph2": "sea",
+    "sg2": "sea",
+    "th2": "sea",
+    "tw2": "sea",
+    "vn2": "sea",
+}
+# account-v1 has no sea cluster
+ACCOUNT_REGIONS = {"sea": "asia"}
+# Limits of the single endpoints until the server reports the real ones
+METHOD_RATE_LIMITS = {
+    "match-v5.getMatch": [(2000, 10)],
+    "match-v5.getMatchIdsByPUUID": [(2000, 10)],
+    "match-v5.getTimeline": [(2000, 10)],
+    "summoner-v4.getByPUUID": [(1600, 60)],
+    "account-v1.getByRiotId": [(1000, 60)],
+    "champion-mastery-v4.getAllChampionMasteriesByPUUID": [(20000, 10)],
+}
+# Endpoints that neither take nor return PUUIDs, any key can send them. None of the
+# endpoints in use qualifies: match ids and Riot IDs are plain, but matches, timelines
+# and accounts contain PUUIDs.
+SHARDED_METHODS: Set[str] = set()
+# Key of every request in the other methods, so all stored PUUIDs share its namespace
+PUUID_KEY_INDEX = 0
+
+
+def get_platform_host(platform: str) -> str:
+    return f"https://{platform.lower()}.api.riotgames.com"
+
+
+def get_region_host(platform: str, account: bool = False) -> str:
+    region = PLATFORM_REGIONS[platform.lower()]
+    if account:
+        region = ACCOUNT_REGIONS.get(region, region)
+    return f"https://{region}.api.riotgames.com"
+
+
+def get_match_platform(match_id: str) -> str:
+    """Match ids start with their platform, e.g. EUW1_7123456789"""
+    return match_id.split("_")[0].lower()
 
 
 class RiotHelper:
+    """
+    Client for the Riot-API. Requests are routed to the host of the summoner's platform
+    or the region of a match. Every key in RIOT_API_KEYS (comma separated) has its own
+    rate limiters per host.
+
+    Every key belongs to its own application and Riot encrypts PUUIDs per application,
+    so the PUUIDs of the stored summoners, matches and timelines are only comparable
+    if they were all fetched with one key. Every request that takes or returns PUUIDs
+    is sent with the first key, only SHARDED_METHODS are spread over all keys.
+    """
+
     _instance = None
     _lock: Lock = Lock()
 
@@ -24,77 +105,269 @@ class RiotHelper:
                     cls._instance = super().__new__(cls)
                     load_dotenv()
 
-                    # Initialize Riot API Key
-                    cls._instance.riot_api_key = os.getenv("RIOT_API_KEY")
-                    if not cls._instance.riot_api_key:
+                    # Initialize Riot API Keys
+                    riot_api_keys = os.getenv("RIOT_API_KEYS") or os.getenv(
+                        "RIOT_API_KEY", ""
+                    )
+                    cls._instance.riot_api_keys = [
+                        key.strip() for key in riot_api_keys.split(",") if key.strip()
+                    ]
+                    if not cls._instance.riot_api_keys:
                         raise ValueError("No Riot API Key found in Environment")
 
-                    # Initialize HTTP Client
-                    cls._instance.client = httpx.AsyncClient()
-                    cls._instance.client.headers.update(
-                        {"X-Riot-Token": cls._instance.riot_api_key}
-                    )
+                    # Initialize HTTP Client, the key is set per request
+                    cls._instance.connect()
+
+                    # Initialize Rate Limiters, Riot counts them per key and routing host
+                    cls._instance.app_limiters = {}
+                    cls._instance.method_limiters = {}
 
         return cls._instance
 
-    @sleep_and_retry
-    @limits(calls=20, period=1)
-    @limits(calls=100, period=120)
-    async def _make_request(self, url: str):
-        response = await self.client.get(url)
-        response.raise_for_status()
-        return response.json()
+    def connect(self):
+        """
+        Create the client, again after a disconnect, e.g. when the api starts again or
+        another task runs in the same process
+        """
+        self.client = httpx.AsyncClient(
+            http2=os.getenv("RIOT_HTTP2", "true").lower() == "true",
+            limits=httpx.Limits(
+                max_connections=int(
+                    os.getenv("RIOT_MAX_CONNECTIONS", RIOT_MAX_CONNECTIONS)
+                ),
+                max_keepalive_connections=int(
+                    os.getenv(
+                        "RIOT_MAX_KEEPALIVE_CONNECTIONS",
+                        RIOT_MAX_KEEPALIVE_CONNECTIONS,
+                    )
+                ),
+                keepalive_expiry=float(
+                    os.getenv("RIOT_KEEPALIVE_EXPIRY", RIOT_KEEPALIVE_EXPIRY)
+                ),
+            ),
+            timeout=httpx.Timeout(
+                float(os.getenv("RIOT_TIMEOUT", RIOT_TIMEOUT)),
+                connect=float(os.getenv("RIOT_CONNECT_TIMEOUT", RIOT_CONNECT_TIMEOUT)),
+            ),
+        )
+
+    async def disconnect(self):
+        await self.client.aclose()
+        print("Closed Riot-API client")
+
+    async def warmup(self, platforms: Iterable[str] = (DEFAULT_PLATFORM,)):
+        """
+        Open the connections to the platform and regional hosts. The requests carry no
+        key, so they don't count against the rate limits.
+        """
+        hosts = sorted(
+            {get_platform_host(platform) for platform in platforms}
+            | {get_region_host(platform) for platform in platforms}
+        )
+        results = await asyncio.gather(
+            *[self.client.head(host) for host in hosts], return_exceptions=True
+        )
+        connected = 0
+        for host, result in zip(hosts, results):
+            if isinstance(result, Exception):
+                print(f"Could not connect to [{host}]: {result}")
+            else:
+                connected += 1
+        print(f"Connected to {connected} of {len(hosts)} Riot-API hosts")
+
+    def _get_limiters(
+        self, key_index: int, host: str, method: str
+    ) -> Tuple[RateLimiter, RateLimiter]:
+        app_limiter = self.app_limiters.get((key_index, host))
+        if app_limiter is None:
+            app_limiter = RateLimiter(f"key {key_index} {host}", APP_RATE_LIMITS)
+            self.app_limiters[(key_index, host)] = app_limiter
+        method_limiter = self.method_limiters.get((key_index, host, method))
+        if method_limiter is None:
+            method_limiter = RateLimiter(
+                f"key {key_index} {host} {method}", METHOD_RATE_LIMITS.get(method, [])
+            )
+            self.method_limiters[(key_index, host, method)] = method_limiter
+        return app_limiter, method_limiter
+
+    async def _acquire_key(
+        self, host: str, method: str, key_indexes: List[int]
+    ) -> Tuple[str, RateLimiter, RateLimiter]:
+        """
+        Wait for the key that can send a request to the host the soonest and record
+        the request on its limiters. The key is picked again after every sleep, as
+        other requests may have taken it in the meantime. Checking and recording
+        happen without an await in between, so no lock is needed on the event loop.
+        """
+        while True:
+            now = time.monotonic()
+            picked = None
+            for key_index in key_indexes:
+                limiters = self._get_limiters(key_index, host, method)
+                wait = max(limiter.wait_time(now) for limiter in limiters)
+                if picked is None or wait < picked[0]:
+                    picked = (wait, self.riot_api_keys[key_index], limiters)
+            wait, key, (app_limiter, method_limiter) = picked
+            if wait <= 0:
+                app_limiter.record(now)
+                method_limiter.record(now)
+                return key, app_limiter, method_limiter
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def _update_limiters(
+        response: httpx.Response, app_limiter: RateLimiter, method_limiter: RateLimiter
+    ):
+        now = time.monotonic()
+        headers = response.headers
+        for limiter, prefix in ((app_limiter, "X-App"), (method_limiter, "X-Method")):
+            limits = headers.get(f"{prefix}-Rate-Limit")
+            if limits:
+                limiter.update_limits(parse_rate_limit_header(limits))
+            counts = headers.get(f"{prefix}-Rate-Limit-Count")
+            if counts:
+                limiter.sync_counts(parse_rate_limit_header(counts), now)
+
+        if response.status_code == 429 and "Retry-After" in headers:
+            retry_after = float(headers["Retry-After"])
+            limit_type = headers.get("X-Rate-Limit-Type", "service")
+            print(
+                f"Rate limit exceeded [{limit_type}] on [{method_limiter.name}], "
+                f"retrying after {retry_after}s"
+            )
+            if limit_type == "application":
+                app_limiter.block(retry_after, now)
+            else:
+                # method and service (no type) limits only affect the endpoint
+                method_limiter.block(retry_after, now)
+
+    async def _make_request(self, url: str, method: str):
+        if method in SHARDED_METHODS:
+            key_indexes = list(range(len(self.riot_api_keys)))
+        else:
+            key_indexes = [PUUID_KEY_INDEX]
+        host = httpx.URL(url).host
+        for attempt in range(MAX_RETRIES + 1):
+            key, app_limiter, method_limiter = await self._acquire_key(
+                host, method, key_indexes
+            )
+            response = await self.client.get(url, headers={"X-Riot-Token": key})
+            self._update_limiters(response, app_limiter, method_limiter)
+
+            if attempt < MAX_RETRIES:
+                if response.status_code == 429 and "Retry-After" in response.headers:
+                    # the limiters were blocked until the server accepts requests again
+                    continue
+                if response.status_code == 429 or response.status_code >= 500:
+                    backoff = BACKOFF_BASE * 2**attempt
+                    print(
+                        f"Riot-API responded with {response.status_code} for [{url}], "
+                        f"retrying in {backoff}s"
+                    )
+                    await asyncio.sleep(backoff)
+                    continue
+            response.raise_for_status()
+            return response.json()
 
     async def get_match_riot(self, match_id: str) -> Optional[MatchV5DTO]:
         try:
             print(f"Fetching Match [{match_id}] with Riot-API")
-            url = f"https://europe.api.riotgames.com/lol/match/v5/matches/{match_id}"
-            data = await self._make_request(url)
+            host = get_region_host(get_match_platform(match_id))
+            url = f"{host}/lol/match/v5/matches/{match_id}"
+            data = await self._make_request(url, "match-v5.getMatch")
             return MatchV5DTO(**data)
         except Exception as e:
             print(f"Error while fetching Match [{match_id}] with Riot-API: {e}")
             return None
 
+    async def get_match_raw_riot(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Only validates the fields we index or query and returns the payload untouched,
+        build a MatchV5DTO from it when the full model is needed
+        """
+        try:
+            print(f"Fetching raw Match [{match_id}] with Riot-API")
+            host = get_region_host(get_match_platform(match_id))
+            url = f"{host}/lol/match/v5/matches/{match_id}"
+            data = await self._make_request(url, "match-v5.getMatch")
+            MatchSkeletonDTO.model_validate(data)
+            return data
+        except Exception as e:
+            print(f"Error while fetching raw Match [{match_id}] with Riot-API: {e}")
+            return None
+
+    async def get_timeline_riot(self, match_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Raw timeline of a match. Only the metadata is validated, the event enums of
+        TimelineDTO don't cover every event type riot sends.
+        """
+        try:
+            print(f"Fetching Timeline [{match_id}] with Riot-API")
+            host = get_region_host(get_match_platform(match_id))
+            url = f"{host}/lol/match/v5/matches/{match_id}/timeline"
+            data = await self._make_request(url, "match-v5.getTimeline")
+            TimelineMetadata.model_validate(data["metadata"])
+            return data
+        except Exception as e:
+            print(f"Error while fetching Timeline [{match_id}] with Riot-API: {e}")
+            return None
+
     async def get_match_list_riot(
-        self, summoner: SummonerDTO, count: int = 100, offset: int = 0
-    ) -> list[str]:
+        self,
+        puuid: str,
+        count: int = 100,
+        offset: int = 0,
+        start_time: Optional[int] = None,
+        end_time: Optional[int] = None,
+        platform: str = DEFAULT_PLATFORM,
+    ) -> Optional[List[str]]:
+        """Times are epoch seconds, returns None if the list could not be fetched"""
         try:
-            print(f"Fetching Matchlist [{summoner.puuid}] with Riot-API")
-            url = f"https://europe.api.riotgames.com/lol/match/v5/matches/by-puuid/{summoner.puuid}/ids?start={offset}&count={count}"
-            return await self._make_request(url)
+            print(f"Fetching Matchlist [{puuid}] with Riot-API")
+            url = f"{get_region_host(platform)}/lol/match/v5/matches/by-puuid/{puuid}/ids?start={offset}&count={count}"
+            if start_time is not None:
+                url += f"&startTime={start_time}"
+            if end_time is not None:
+                url += f"&endTime={end_time}"
+            return await self._make_request(url, "match-v5.getMatchIdsByPUUID")
         except Exception as e:
             print(
-                f"Error while fetching Matchlist of Summoner [{summoner.puuid}] with Riot-API: {e}"
+                f"Error while fetching Matchlist of Summoner [{puuid}] with Riot-API: {e}"
             )
-            return []
+            return None
 
-    async def get_summoner_by_puuid_riot(self, puuid: str) -> Optional[SummonerDTO]:
+    async def get_summoner_by_puuid_riot(
+        self, puuid: str, platform: str = DEFAULT_PLATFORM
+    ) -> Optional[SummonerDTO]:
         try:
             print(f"Fetching Summoner [{puuid}] with Riot-API")
-            url = f"https://euw1.api.riotgames.com/lol/summoner/v4/summoners/by-puuid/{puuid}"
-            data = await self._make_request(url)
-            return SummonerDTO(**data)
+            url = f"{get_platform_host(platform)}/lol/summoner/v4/summoners/by-puuid/{puuid}"
+            data = await self._make_request(url, "summoner-v4.getByPUUID")
+            return SummonerDTO(**data, platform=platform.lower())
         except Exception as e:
             print(f"Error while fetching Summoner [{puuid}] with Riot-API: {e}")
             return None
 
-    async def get_account_by_tag(self, name: str, tag: str) -> Optional[AccountDTO]:
+    async def get_account_by_tag(
+        self, name: str, tag: str, platform: str = DEFAULT_PLATFORM
+    ) -> Optional[AccountDTO]:
         try:
             tag = tag.replace("#", "")
             print(f"Fetching Account [{name} - {tag}] with Riot-API")
-            url = f"https://europe.api.riotgames.com/riot/account/v1/accounts/by-riot-id/{name}/{tag}"
-            data = await self._make_request(url)
+            host = get_region_host(platform, account=True)
+            url = f"{host}/riot/account/v1/accounts/by-riot-id/{name}/{tag}"
+            data = await self._make_request(url, "account-v1.getByRiotId")
             return AccountDTO(**data)
         except Exception as e:
             print(f"Error while fetching Account [{name} - {tag}] with Riot-API: {e}")
             return None
 
     async def get_summoner_by_account_tag(
-        self, name: str, tag: str
+        self, name: str, tag: str, platform: str = DEFAULT_PLATFORM
     ) -> Optional[SummonerDTO]:
-        account = await self.get_account_by_tag(name, tag)
+        account = await self.get_account_by_tag(name, tag, platform)
         if account:
-            summoner = await self.get_summoner_by_puuid_riot(account.puuid)
+            summoner = await self.get_summoner_by_puuid_riot(account.puuid, platform)
             if summoner:
                 summoner.gameName = account.gameName
                 summoner.tagLine = account.tagLine
@@ -102,12 +375,14 @@ class RiotHelper:
         return None
 
     async def get_champion_mastery_by_puuid_riot(
-        self, puuid: str
+        self, puuid: str, platform: str = DEFAULT_PLATFORM
     ) -> List[ChampionMasteryDTO]:
         try:
             print(f"Fetching Champion Mastery for Summoner [{puuid}] with Riot-API")
-            url = f"https://euw1.api.riotgames.com/lol/champion-mastery/v4/champion-masteries/by-puuid/{puuid}"
-            data = await self._make_request(url)
+            url = f"{get_platform_host(platform)}/lol/champion-mastery/v4/champion-masteries/by-puuid/{puuid}"
+            data = await self._make_request(
+                url, "champion-mastery-v4.getAllChampionMasteriesByPUUID"
+            )
             return [ChampionMasteryDTO(**champion) for champion in data]
         except Exception as e:
             print(
@@ -120,7 +395,7 @@ async def main():
     rh = RiotHelper()
     summoner = await rh.get_summoner_by_account_tag("AngryBacteria", "cnap")
     print(summoner)
-    match_list = await rh.get_match_list_riot(summoner)
+    match_list = await rh.get_match_list_riot(summoner.puuid)
     print(match_list)
     champion_mastery = await rh.get_champion_mastery_by_puuid_riot(summoner.puuid)
     print(champion_mastery[0].championPoints)
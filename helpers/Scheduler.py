@@ -0,0 +1,112 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from helpers.DBHelper import DBHelper
+
+
+class Job(BaseModel):
+    jobId: str
+    kind: str
+    target: str = ""
+    # jobs with a higher priority run first
+    priority: int = 0
+    # seconds between two runs
+    interval: float
+    nextRun: float = 0
+    lastRun: Optional[float] = None
+    lastStatus: Optional[str] = None
+
+
+JobHandler = Callable[[List[Job]], Awaitable[None]]
+# returns the seconds until the next run of jobs that should not use their interval
+IntervalPolicy = Callable[[List[Job]], Awaitable[Dict[str, float]]]
+
+
+class Scheduler:
+    """
+    Runs jobs persisted in the `job` collection, so a restart resumes the schedule
+    instead of starting over. All due jobs of a kind are handed to its handler as one
+    batch (e.g. every due summoner is synced in a single pipeline run).
+    """
+
+    def __init__(self, jitter: float = 0.1, max_sleep: float = 60):
+        self.db_helper = DBHelper()
+        self.handlers: Dict[str, JobHandler] = {}
+        self.interval_policies: Dict[str, IntervalPolicy] = {}
+        self.jitter = jitter
+        self.max_sleep = max_sleep
+
+    def register_handler(
+        self,
+        kind: str,
+        handler: JobHandler,
+        interval_policy: Optional[IntervalPolicy] = None,
+    ):
+        self.handlers[kind] = handler
+        if interval_policy:
+            self.interval_policies[kind] = interval_policy
+
+    async def register_jobs(self, jobs: List[Job]):
+        now = time.time()
+        for job in jobs:
+            # spread the first runs so a fresh schedule doesn't start with a burst
+            job.nextRun = now + random.uniform(0, self.jitter * job.interval)
+        await self.db_helper.register_jobs([job.model_dump() for job in jobs])
+
+    def _next_run(self, interval: float, now: float) -> float:
+        return now + interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def _get_intervals(self, kind: str, jobs: List[Job]) -> Dict[str, float]:
+        interval_policy = self.interval_policies.get(kind)
+        if interval_policy is None:
+            return {}
+        try:
+            return await interval_policy(jobs)
+        except Exception as error:
+            print(f"Error computing intervals for jobs of kind [{kind}]: {error}")
+            return {}
+
+    async def run_due_jobs(self):
+        due_jobs = [
+            Job(**job) for job in await self.db_helper.get_due_jobs(time.time())
+        ]
+        batches: Dict[str, List[Job]] = {}
+        for job in due_jobs:
+            batches.setdefault(job.kind, []).append(job)
+
+        # batches are started in the order of their most important job
+        for kind, jobs in batches.items():
+            handler = self.handlers.get(kind)
+            if handler is None:
+                print(f"No handler registered for jobs of kind [{kind}]")
+                status = "error: no handler"
+            else:
+                print(f"Running {len(jobs)} jobs of kind [{kind}]")
+                try:
+                    await handler(jobs)
+                    status = "success"
+                except Exception as error:
+                    print(f"Error running jobs of kind [{kind}]: {error}")
+                    status = f"error: {error}"
+            intervals = await self._get_intervals(kind, jobs)
+            now = time.time()
+            for job in jobs:
+                job.lastRun = now
+                job.lastStatus = status
+                job.nextRun = self._next_run(
+                    intervals.get(job.jobId, job.interval), now
+                )
+            await self.db_helper.update_job_runs([job.model_dump() for job in jobs])
+
+    async def run_forever(self):
+        while True:
+            await self.run_due_jobs()
+            next_run = await self.db_helper.get_next_job_run()
+            sleep_time = self.max_sleep
+            if next_run is not None:
+                sleep_time = min(max(next_run - time.time(), 0), self.max_sleep)
+            await asyncio.sleep(sleep_time)
@@ -0,0 +1,30 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+# Only the fields of MatchV5DTO that are indexed or queried. Unknown fields are
+# ignored, so validating a raw match against it skips the nested participant models.
+
+
+class Participant(BaseModel):
+    puuid: str
+
+
+class Metadata(BaseModel):
+    matchId: str
+    participants: List[str]
+
+
+class Info(BaseModel):
+    gameCreation: int
+    gameMode: Optional[str] = None
+    gameType: Optional[str] = None
+    gameVersion: Optional[str] = None
+    queueId: int
+    participants: List[Participant]
+
+
+class MatchSkeletonDTO(BaseModel):
+    metadata: Metadata
+    info: Info
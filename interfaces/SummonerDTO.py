@@ -12,3 +12,4 @@ class SummonerDTO(BaseModel):
     summonerLevel: Optional[int] = None
     gameName: Optional[str] = None
     tagLine: Optional[str] = None
+    platform: Optional[str] = None
@@ -2,7 +2,8 @@ import asyncio
 from typing import List, Dict, Optional
 
 from helpers.DBHelper import DBHelper
-from helpers.RiotHelper import RiotHelper
+from helpers.Resources import Resources
+from helpers.RiotHelper import DEFAULT_PLATFORM, RiotHelper
 
 
 class FillSummonersTask:
@@ -49,7 +50,9 @@ class FillSummonersTask:
             if not account["core"] and core_only:
                 continue
             summoner_data = await self.riot_helper.get_summoner_by_account_tag(
-                account["name"], account["tag"]
+                account["name"],
+                account["tag"],
+                account.get("platform", DEFAULT_PLATFORM),
             )
             if summoner_data is not None:
                 summoner_objects.append(summoner_data)
@@ -59,8 +62,9 @@ class FillSummonersTask:
 
 
 async def main():
-    task = FillSummonersTask()
-    await task.fill_summoners()
+    async with Resources():
+        task = FillSummonersTask()
+        await task.fill_summoners()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, get_args
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from bson import ObjectId
+
+from helpers.DBHelper import PARTICIPANT_STATS_INFO_FIELDS, DBHelper, get_patch
+from helpers.Resources import Resources
+from interfaces.MatchV5DTO import Challenges, Info, Participant
+
+EXPORT_NAME = "participants_parquet"
+EXPORT_DIRECTORY = "export/participants"
+# matches inserted by other processes just now may still get a smaller _id than the
+# newest exported one, so the newest matches are left for the next run
+EXPORT_LAG = 60
+EXPORT_BATCH_SIZE = 1000
+PARTITIONING = ds.partitioning(
+    pa.schema([("patch", pa.string()), ("queueId", pa.int64())]), flavor="hive"
+)
+ARROW_TYPES = {
+    bool: pa.bool_(),
+    int: pa.int64(),
+    float: pa.float64(),
+    str: pa.string(),
+}
+
+
+def get_arrow_type(annotation) -> Optional[pa.DataType]:
+    """Arrow type of a scalar model field like Optional[int], None for other fields"""
+    for python_type in get_args(annotation) or (annotation,):
+        if python_type in ARROW_TYPES:
+            return ARROW_TYPES[python_type]
+    return None
+
+
+def build_participant_schema() -> pa.Schema:
+    """
+    Columns of every exported file, taken from the match models so all files share one
+    schema. Fields riot adds later are only exported once they are in the models.
+    """
+    fields = {"matchId": pa.string(), "patch": pa.string()}
+    for field in PARTICIPANT_STATS_INFO_FIELDS:
+        fields[field] = get_arrow_type(Info.model_fields[field].annotation)
+    # the rows use riot's keys, which are the aliases of renamed model fields
+    for field, info in Participant.model_fields.items():
+        arrow_type = get_arrow_type(info.annotation)
+        if arrow_type is not None:
+            fields[info.alias or field] = arrow_type
+    # challenges are ints or floats depending on the game, floats keep one type
+    for field, info in Challenges.model_fields.items():
+        fields[f"challenges_{info.alias or field}"] = pa.float64()
+    return pa.schema(list(fields.items()))
+
+
+PARTICIPANT_SCHEMA = build_participant_schema()
+
+
+def convert_value(value: Any, arrow_type: pa.DataType) -> Any:
+    """The value as the python type of the column, None if it doesn't fit"""
+    if pa.types.is_string(arrow_type):
+        return value if isinstance(value, str) else None
+    if pa.types.is_boolean(arrow_type):
+        return value if isinstance(value, bool) else None
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return None
+    if pa.types.is_integer(arrow_type):
+        return int(value) if float(value).is_integer() else None
+    return float(value)
+
+
+def build_participant_rows(match: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    One flat row per participant with the match info, every scalar participant field
+    and the challenges as challenges_<name>, typed like PARTICIPANT_SCHEMA
+    """
+    info = match.get("info", {})
+    match_fields = {
+        "matchId": match["metadata"]["matchId"],
+        "patch": get_patch(info.get("gameVersion") or ""),
+        **{field: info.get(field) for field in PARTICIPANT_STATS_INFO_FIELDS},
+    }
+
+    rows = []
+    for participant in info.get("participants", []):
+        row = dict(match_fields)
+        row.update(participant)
+        for field, value in (participant.get("challenges") or {}).items():
+            row[f"challenges_{field}"] = value
+        rows.append(
+            {
+                field.name: convert_value(row[field.name], field.type)
+                for field in PARTICIPANT_SCHEMA
+                if row.get(field.name) is not None
+            }
+        )
+    return rows
+
+
+def build_table(rows: List[Dict[str, Any]]) -> pa.Table:
+    # columns missing in the rows are filled with nulls of their type
+    return pa.Table.from_pylist(rows, schema=PARTICIPANT_SCHEMA)
+
+
+class ParquetExportTask:
+    """
+    Appends the participants of newly ingested matches to a parquet dataset
+    partitioned by patch and queue. The _id of the last exported match is stored in
+    the export_state collection, every run continues after it.
+    """
+
+    def __init__(self, directory: str = ""):
+        self.db_helper = DBHelper()
+        self.directory = directory or os.getenv(
+            "PARQUET_EXPORT_DIRECTORY", EXPORT_DIRECTORY
+        )
+
+    async def export(self, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+        state = await self.db_helper.get_export_state(EXPORT_NAME)
+        if state is None:
+            print("Could not read the export state. Stopping the export")
+            return 0
+
+        before_id = ObjectId.from_datetime(
+            datetime.now(timezone.utc) - timedelta(seconds=EXPORT_LAG)
+        )
+        exported = 0
+        batch = []
+        async for match in self.db_helper.stream_matches_by_id(
+            state.get("lastId"), before_id
+        ):
+            batch.append(match)
+            if len(batch) >= batch_size:
+                exported += await self._write_batch(batch)
+                batch = []
+        if batch:
+            exported += await self._write_batch(batch)
+        print(f"Exported {exported} new matches to [{self.directory}]")
+        return exported
+
+    async def _write_batch(self, matches: List[Dict[str, Any]]) -> int:
+        rows = [row for match in matches for row in build_participant_rows(match)]
+        if rows:
+            # files are named after the first match, a batch that is exported again
+            # after a failed state update overwrites its files instead of duplicating
+            await asyncio.to_thread(
+                ds.write_dataset,
+                build_table(rows),
+                self.directory,
+                schema=PARTICIPANT_SCHEMA,
+                format="parquet",
+                partitioning=PARTITIONING,
+                basename_template=f"part-{matches[0]['_id']}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+            )
+        await self.db_helper.update_export_state(
+            EXPORT_NAME,
+            {"lastId": matches[-1]["_id"], "lastRun": int(time.time() * 1000)},
+        )
+        return len(matches)
+
+
+async def main():
+    async with Resources():
+        task = ParquetExportTask()
+        await task.export()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
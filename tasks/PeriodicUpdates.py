@@ -1,75 +1,161 @@
 import asyncio
-from datetime import datetime
+from typing import List, Optional
 
+from helpers.ActivityPolicy import ActivityPolicy
 from helpers.DBHelper import DBHelper
-from helpers.RiotHelper import RiotHelper
+from helpers.MatchPipeline import MatchPipeline
+from helpers.Resources import Resources
+from helpers.RiotHelper import DEFAULT_PLATFORM, RiotHelper
+from helpers.Scheduler import Job, Scheduler
+from tasks.FillSummoners import FillSummonersTask
+
+# multiples of the base interval between two runs of a job, core accounts are polled
+# more often than the others and match syncs back off further for idle summoners
+MATCH_SYNC_INTERVALS = {True: 1, False: 4}
+SUMMONER_REFRESH_INTERVALS = {True: 10, False: 20}
+MASTERY_SNAPSHOT_INTERVALS = {True: 20, False: 60}
+JOB_REGISTRATION_INTERVAL = 10
+TIMELINE_BACKFILL_INTERVAL = 20
 
 
 class MainTask:
     def __init__(self):
         self.db_helper = DBHelper()
         self.riot_helper = RiotHelper()
+        self.match_pipeline = MatchPipeline()
 
-    async def update_match_data(self, offset=0, count=69):
-        existing_summoners = await self.db_helper.get_summoners()
+    async def update_match_data(
+        self, count=100, pages=5, backfill=False, puuids: Optional[List[str]] = None
+    ):
+        existing_summoners = await self.db_helper.get_summoners(puuids=puuids, limit=0)
         if not existing_summoners:
             print(
                 "No Summoner data available to update match history. Stopping the loop"
             )
             return
 
-        for summoner in existing_summoners:
-            print(f"Updating Match Data for Summoner [{summoner['puuid']}]")
-            riot_match_ids = await self.riot_helper.get_match_list_riot(
-                summoner, count, offset
-            )
-            filtered_ids = await self.db_helper.get_non_existing_match_ids(
-                riot_match_ids
-            )
-            if len(filtered_ids) == 0:
-                print(f"No new matches for summoner [{summoner['puuid']}]")
-            else:
-                match_data = []
-                for match_id in filtered_ids:
-                    match = await self.riot_helper.get_match_riot(match_id)
-                    if match:
-                        match_data.append(match)
-                await self.db_helper.update_matches(match_data)
-
-    async def update_summoner_data(self):
-        existing_summoners = await self.db_helper.get_summoners()
+        written = await self.match_pipeline.run(
+            existing_summoners, count, pages, backfill
+        )
+        print(f"Stored {written} new matches")
+
+    async def update_summoner_data(self, puuids: Optional[List[str]] = None):
+        existing_summoners = await self.db_helper.get_summoners(puuids=puuids, limit=0)
         if existing_summoners:
             new_summoners = []
             for summoner in existing_summoners:
                 summoner_riot = await self.riot_helper.get_summoner_by_puuid_riot(
-                    summoner["puuid"]
+                    summoner["puuid"], summoner.get("platform") or DEFAULT_PLATFORM
                 )
                 if summoner_riot:
                     new_summoners.append(summoner_riot)
             await self.db_helper.update_summoners(new_summoners)
 
+    async def update_mastery_data(self, puuids: Optional[List[str]] = None):
+        existing_summoners = await self.db_helper.get_summoners(puuids=puuids, limit=0)
+        for summoner in existing_summoners:
+            masteries = await self.riot_helper.get_champion_mastery_by_puuid_riot(
+                summoner["puuid"], summoner.get("platform") or DEFAULT_PLATFORM
+            )
+            await self.db_helper.update_mastery(summoner["puuid"], masteries)
+
+    async def backfill_timelines(self):
+        written = await self.match_pipeline.backfill_timelines()
+        print(f"Stored {written} missing timelines")
+
     async def fill_match_data(self):
-        for i in range(0, 2000, 95):
-            print(f"INSERTING WITH I = {i}")
-            await self.update_match_data(i, 95)
-
-    async def interval_update(self, iteration, interval_time):
-        print(f"UPDATING MATCH DATA [{iteration}]: {datetime.now().isoformat()}")
-        iteration += 1
-        if iteration == 10:
-            print(f"UPDATING SUMMONER DATA: {datetime.now().isoformat()}")
-            await self.update_summoner_data()
-            iteration = 0
-            print(f"UPDATED SUMMONER DATA: {datetime.now().isoformat()}")
-        await self.update_match_data(0, 69)
-        print(f"UPDATED MATCH DATA [{iteration}]: {datetime.now().isoformat()}")
-        await asyncio.sleep(interval_time / 1000)  # Convert milliseconds to seconds
-        await self.interval_update(iteration, interval_time)
+        await self.update_match_data(100, 20, backfill=True)
+
+    async def build_jobs(self, interval_time) -> List[Job]:
+        interval = interval_time / 1000  # Convert milliseconds to seconds
+        core_accounts = {
+            (account["name"].lower(), account["tag"].replace("#", "").lower())
+            for account in FillSummonersTask().account_names
+            if account["core"]
+        }
+        jobs = [
+            Job(
+                jobId="register_jobs",
+                kind="register_jobs",
+                priority=3,
+                interval=interval * JOB_REGISTRATION_INTERVAL,
+            ),
+            Job(
+                jobId="timeline_backfill",
+                kind="timeline_backfill",
+                priority=0,
+                interval=interval * TIMELINE_BACKFILL_INTERVAL,
+            ),
+        ]
+        for summoner in await self.db_helper.get_summoners(limit=0):
+            core = (
+                str(summoner.get("gameName", "")).lower(),
+                str(summoner.get("tagLine", "")).lower(),
+            ) in core_accounts
+            jobs.append(
+                Job(
+                    jobId=f"match_sync:{summoner['puuid']}",
+                    kind="match_sync",
+                    target=summoner["puuid"],
+                    priority=2 if core else 1,
+                    interval=interval * MATCH_SYNC_INTERVALS[core],
+                )
+            )
+            jobs.append(
+                Job(
+                    jobId=f"summoner_refresh:{summoner['puuid']}",
+                    kind="summoner_refresh",
+                    target=summoner["puuid"],
+                    priority=1 if core else 0,
+                    interval=interval * SUMMONER_REFRESH_INTERVALS[core],
+                )
+            )
+            jobs.append(
+                Job(
+                    jobId=f"mastery_snapshot:{summoner['puuid']}",
+                    kind="mastery_snapshot",
+                    target=summoner["puuid"],
+                    priority=0,
+                    interval=interval * MASTERY_SNAPSHOT_INTERVALS[core],
+                )
+            )
+        return jobs
+
+    async def interval_update(self, interval_time):
+        scheduler = Scheduler()
+
+        async def register_jobs(_: List[Job]):
+            # picks up summoners added since the last registration, an empty summoner
+            # list (e.g. a failed query) must not wipe the stored schedule
+            jobs = await self.build_jobs(interval_time)
+            if any(job.kind == "match_sync" for job in jobs):
+                await scheduler.register_jobs(jobs)
+
+        async def sync_matches(jobs: List[Job]):
+            await self.update_match_data(puuids=[job.target for job in jobs])
+
+        async def backfill_timelines(_: List[Job]):
+            await self.backfill_timelines()
+
+        async def refresh_summoners(jobs: List[Job]):
+            await self.update_summoner_data(puuids=[job.target for job in jobs])
+
+        async def snapshot_masteries(jobs: List[Job]):
+            await self.update_mastery_data(puuids=[job.target for job in jobs])
+
+        scheduler.register_handler("register_jobs", register_jobs)
+        scheduler.register_handler("match_sync", sync_matches, ActivityPolicy())
+        scheduler.register_handler("summoner_refresh", refresh_summoners)
+        scheduler.register_handler("mastery_snapshot", snapshot_masteries)
+        scheduler.register_handler("timeline_backfill", backfill_timelines)
+        await register_jobs([])
+        await scheduler.run_forever()
 
 
 async def main():
-    task = MainTask()
-    await task.update_match_data(0, 2)
+    async with Resources():
+        task = MainTask()
+        await task.update_match_data(2, 1)
 
 
 if __name__ == "__main__":